@@ -0,0 +1,251 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import math
+import heapq
+from multiprocessing import Pool
+import numpy as np
+from utils.csr_graph import haversine
+
+
+def search(indptr, indices, sources, costs, s, t, h=None):
+    """A* (Dijkstra if h is None) between node positions on plain lists.
+    Returns the positions of the edges of the path, None if t cannot be reached."""
+    dist = {s: 0.0}
+    parent = {s: -1}
+    heap = [(0.0, 0.0, s)]
+    while heap:
+        _, d, u = heapq.heappop(heap)
+        if u == t:
+            break
+        if d > dist[u]:
+            continue
+        for k in range(indptr[u], indptr[u + 1]):
+            v = indices[k]
+            nd = d + costs[k]
+            if nd < dist.get(v, math.inf):
+                dist[v] = nd
+                parent[v] = k
+                heapq.heappush(heap, (nd + h[v] if h else nd, nd, v))
+    else:
+        return None
+    edges = []
+    k = parent[t]
+    while k != -1:
+        edges.append(k)
+        k = parent[sources[k]]
+    edges.reverse()
+    return edges
+
+
+def tree(indptr, indices, costs, s, max_cost=math.inf):
+    """Dijkstra from s settling the nodes up to max_cost, returns distances and parent edge positions"""
+    dist = {s: 0.0}
+    parent = {s: -1}
+    heap = [(0.0, s)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        if d > max_cost:
+            break
+        for k in range(indptr[u], indptr[u + 1]):
+            v = indices[k]
+            nd = d + costs[k]
+            if nd < dist.get(v, math.inf):
+                dist[v] = nd
+                parent[v] = k
+                heapq.heappush(heap, (nd, v))
+    return dist, parent
+
+
+class CandidateGenerator:
+    """Candidate paths between two FootNodes for the multi-objective analysis of MODyPer.
+
+    The objectives are weights of a CSRGraph (see graph_loader.py), each one divided by its
+    mean so that they are comparable. The first candidates are the best paths for every
+    single objective, then:
+    - method 'plateau' (default): for each objective, for a uniform mix and for random
+      weighted sums of the objectives, one search from the source and one towards the
+      target give the best path through every node (via node); the via paths up to
+      1 + stretch times the best cost, without loops and through nodes not covered by
+      the candidates already found, are the alternative routes;
+    - method 'random': each candidate is the best path for a random weighted sum of the
+      objectives (weights drawn from a Dirichlet distribution) with every edge cost
+      multiplied by a random factor in [1 - noise, 1 + noise];
+    - method 'penalty': for each objective and for a uniform mix of them, the costs of the
+      edges of every path found are increased by penalty, so that the next search looks
+      for an alternative route.
+    All the random draws are numpy arrays over the edges and the searches run in parallel
+    in a pool of processes. Repeated paths are removed by hashing their edge sequence."""
+
+    def __init__(self, graph, objectives, noise=0.5, penalty=0.3, stretch=0.5, n_mixes=10, seed=None):
+        self.graph = graph
+        self.objectives = list(objectives)
+        self.noise = noise
+        self.penalty = penalty
+        self.stretch = stretch
+        self.n_mixes = n_mixes
+        self.seed = seed
+        costs = []
+        scales = []
+        for objective in self.objectives:
+            values = np.asarray(graph.weights[objective], dtype=np.float64)
+            finite = values[np.isfinite(values)]
+            mean = finite.mean() if len(finite) and finite.mean() > 0 else 1.0
+            costs.append(values / mean)
+            scales.append(graph.heuristic_scale(objective) / mean)
+        # shape (number of objectives, number of edges)
+        self.costs = np.array(costs)
+        self.scales = np.array(scales)
+        self._lists = None
+
+    def lists(self):
+        """plain lists of the CSR arrays, and of the reversed graph with the positions of its edges in the graph"""
+        if self._lists is None:
+            sources = self.graph.edge_sources()
+            order = np.argsort(self.graph.indices, kind='stable')
+            reversed_indptr = np.zeros(self.graph.n_nodes + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.graph.indices, minlength=self.graph.n_nodes), out=reversed_indptr[1:])
+            self._lists = (self.graph.indptr.tolist(), self.graph.indices.tolist(), sources.tolist(),
+                           reversed_indptr.tolist(), sources[order].tolist(), order.tolist())
+        return self._lists
+
+    def heuristic(self, t, mix, factor=1.0):
+        """lower bound of the cost of a mix of objectives from every node to t"""
+        scale = float(np.dot(mix, self.scales)) * factor
+        if not scale > 0:
+            return None
+        straight = haversine(self.graph.lat, self.graph.lon, self.graph.lat[t], self.graph.lon[t])
+        return np.nan_to_num(scale * straight).tolist()
+
+    def path(self, costs, s, t, h=None):
+        indptr, indices, sources = self.lists()[:3]
+        edges = search(indptr, indices, sources, costs, s, t, h)
+        return None if edges is None else tuple(edges)
+
+    def random_paths(self, s, t, n_paths, seed):
+        rng = np.random.default_rng(seed)
+        paths = []
+        for _ in range(n_paths):
+            mix = rng.dirichlet(np.ones(len(self.objectives)))
+            noise = rng.uniform(1 - self.noise, 1 + self.noise, self.costs.shape[1])
+            costs = (mix @ self.costs) * noise
+            paths.append(self.path(costs.tolist(), s, t, self.heuristic(t, mix, 1 - self.noise)))
+        return paths
+
+    def penalty_paths(self, s, t, n_paths, mix):
+        mix = np.asarray(mix, dtype=np.float64)
+        costs = mix @ self.costs
+        h = self.heuristic(t, mix)
+        paths = []
+        for _ in range(n_paths):
+            edges = self.path(costs.tolist(), s, t, h)
+            paths.append(edges)
+            if edges is None:
+                break
+            # penalties only increase the costs, so the heuristic stays admissible
+            costs[list(edges)] *= 1 + self.penalty
+        return paths
+
+    def plateau_paths(self, s, t, n_paths, mix):
+        indptr, indices, sources, reversed_indptr, reversed_indices, order = self.lists()
+        costs = np.asarray(mix, dtype=np.float64) @ self.costs
+        forward, forward_parent = tree(indptr, indices, costs.tolist(), s)
+        if t not in forward:
+            return [None]
+        max_cost = (1 + self.stretch) * forward[t]
+        backward, backward_parent = tree(reversed_indptr, reversed_indices, costs[order].tolist(), t, max_cost)
+
+        vias = sorted((d + backward[v], v) for v, d in forward.items() if v in backward and d + backward[v] <= max_cost)
+        paths = []
+        covered = set()
+        for _, v in vias:
+            if len(paths) >= n_paths:
+                break
+            if v in covered:
+                continue
+            head = []
+            node = v
+            while forward_parent[node] != -1:
+                head.append(forward_parent[node])
+                node = sources[forward_parent[node]]
+            head.reverse()
+            tail = []
+            node = v
+            while backward_parent[node] != -1:
+                k = order[backward_parent[node]]
+                tail.append(k)
+                node = indices[k]
+            nodes = [s] + [indices[k] for k in head] + [indices[k] for k in tail]
+            covered.update(nodes)
+            # the two halves may overlap near the via node
+            if len(set(nodes)) == len(nodes):
+                paths.append(tuple(head + tail))
+        return paths
+
+    def generate(self, source, target, n_paths=1000, method='plateau', workers=1):
+        """up to n_paths distinct candidate paths from source to target, as lists of node ids"""
+        s = self.graph.node_position(source)
+        t = self.graph.node_position(target)
+        n_objectives = len(self.objectives)
+        tasks = [('penalty', (s, t, 1, mix)) for mix in np.eye(n_objectives).tolist()]
+        remaining = max(n_paths - n_objectives, 0)
+        if method == 'plateau':
+            rng = np.random.default_rng(self.seed)
+            mixes = np.eye(n_objectives).tolist() + [[1.0 / n_objectives] * n_objectives]
+            mixes += rng.dirichlet(np.ones(n_objectives), max(self.n_mixes - len(mixes), 0)).tolist()
+            size = -(-remaining // len(mixes))
+            tasks += [('plateau', (s, t, size, mix)) for mix in mixes] if size else []
+        elif method == 'random':
+            chunks = max(1, min(remaining, 4 * workers))
+            seeds = np.random.SeedSequence(self.seed).spawn(chunks)
+            sizes = [remaining // chunks + (1 if i < remaining % chunks else 0) for i in range(chunks)]
+            tasks += [('random', (s, t, size, seed)) for size, seed in zip(sizes, seeds) if size]
+        elif method == 'penalty':
+            mixes = np.eye(n_objectives).tolist() + [[1.0 / n_objectives] * n_objectives]
+            sizes = [remaining // len(mixes) + (1 if i < remaining % len(mixes) else 0) for i in range(len(mixes))]
+            tasks += [('penalty', (s, t, size, mix)) for size, mix in zip(sizes, mixes) if size]
+        else:
+            raise ValueError("Unknown candidate generation method: %s" % method)
+
+        if workers <= 1:
+            results = [run_task(self, task) for task in tasks]
+        else:
+            with Pool(workers, initializer=init_worker, initargs=(self,)) as pool:
+                results = pool.map(run_worker_task, tasks)
+
+        unique = {}
+        for edges in (edges for paths in results for edges in paths):
+            if edges is not None and edges not in unique:
+                unique[edges] = self.node_ids(edges, s)
+        return list(unique.values())[:n_paths]
+
+    def node_ids(self, edges, s):
+        nodes = [s] + self.graph.indices[list(edges)].tolist()
+        return [str(self.graph.node_ids[i]) for i in nodes]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lists'] = None
+        return state
+
+
+def run_task(generator, task):
+    method, args = task
+    if method == 'plateau':
+        return generator.plateau_paths(*args)
+    if method == 'random':
+        return generator.random_paths(*args)
+    return generator.penalty_paths(*args)
+
+
+worker = {}
+
+
+def init_worker(generator):
+    worker['generator'] = generator
+
+
+def run_worker_task(task):
+    return run_task(worker['generator'], task)
@@ -0,0 +1,115 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import re
+import math
+from itertools import islice
+import numpy as np
+from utils.csr_graph import CSRGraph, WEIGHT_PATTERN, check_property_name
+
+
+# pm25[1]: element 1 (time interval) of the list property pm25
+INDEXED_PROPERTY = re.compile(r'^(?P<name>[A-Za-z_][A-Za-z0-9_]*)\[(?P<index>[0-9]+)\]$')
+
+
+def objective_names(objs_notime, objs_time, time_interval):
+    """names of the MODyPer objectives as CSRGraph weights: the time-dependent objectives
+    (list properties of the edges) become an element of the list, e.g. pm25[1]"""
+    return list(objs_notime) + ['%s[%d]' % (obj, time_interval) for obj in objs_time]
+
+
+def edge_value(attributes, objective):
+    """value of an objective (plain or indexed property) in a dict of edge properties, inf if missing"""
+    match = INDEXED_PROPERTY.match(objective)
+    if match:
+        values = attributes.get(match.group('name'))
+        index = int(match.group('index'))
+        value = values[index] if values is not None and index < len(values) else None
+    else:
+        value = attributes.get(objective)
+    return math.inf if value is None else float(value)
+
+
+def graph_from_networkx(G, objectives):
+    """directed CSRGraph with the objectives as weights, from the networkx graph built in the notebook"""
+    node_ids = [str(n) for n in G.nodes()]
+    index = {node_id: i for i, node_id in enumerate(node_ids)}
+    lat = [G.nodes[n].get('lat', 0.0) for n in G.nodes()]
+    lon = [G.nodes[n].get('lon', 0.0) for n in G.nodes()]
+    sources, targets = [], []
+    columns = {objective: [] for objective in objectives}
+    for u, v, attributes in G.edges(data=True):
+        sources.append(index[str(u)])
+        targets.append(index[str(v)])
+        for objective in objectives:
+            columns[objective].append(edge_value(attributes, objective))
+    return CSRGraph.from_edges(node_ids, lat, lon, sources, targets, np.arange(len(sources)), columns,
+                               directed=True)
+
+
+def read_columns(result, dtypes, batch_size):
+    """columns of a query result as numpy arrays with the given dtypes (str, np.int64 or np.float64,
+    null floats become nan), read batch_size records at a time"""
+    chunks = [[] for _ in dtypes]
+    records = iter(result)
+    while True:
+        batch = [record.values() for record in islice(records, batch_size)]
+        if not batch:
+            break
+        for chunk, column, dtype in zip(chunks, zip(*batch), dtypes):
+            if dtype is str:
+                column = [str(value) for value in column]
+            elif dtype == np.float64:
+                column = [np.nan if value is None else value for value in column]
+            chunk.append(np.array(column, dtype=dtype))
+    return [np.concatenate(chunk) if chunk else np.zeros(0, dtype=dtype) for chunk, dtype in zip(chunks, dtypes)]
+
+
+def load_graph(driver, objectives, node_label='FootNode', allowed=None, batch_size=100000):
+    """directed CSRGraph of the node_label/ROUTE graph with the objectives as weights, read from Neo4j.
+
+    Only the id and the coordinates of the nodes and the objectives of the edges are returned by
+    the queries (the time-dependent objectives such as pm25[1] are indexed on the server) and the
+    records are read in batches of batch_size straight into numpy columns, so neither the other
+    properties nor a dict for every node and edge are built. With allowed (e.g.
+    'pedestrian_allowed_grafmove') only the nodes where that property is 'yes' are loaded.
+    Missing objective values are inf."""
+    node_label = check_property_name(node_label)
+    objectives = [check_property_name(objective, WEIGHT_PATTERN) for objective in objectives]
+    node_filter = "WHERE n.%s = 'yes'" % check_property_name(allowed) if allowed else ""
+    edge_filter = "WHERE n.%s = 'yes' AND m.%s = 'yes'" % (allowed, allowed) if allowed else ""
+
+    with driver.session(fetch_size=batch_size) as session:
+        result = session.run("""
+            MATCH (n:%s) %s
+            RETURN id(n) as node, n.id as id, n.lat as lat, n.lon as lon""" % (node_label, node_filter))
+        internal, node_ids, lat, lon = read_columns(result, [np.int64, str, np.float64, np.float64], batch_size)
+
+        result = session.run("""
+            MATCH (n:%s)-[r:ROUTE]->(m:%s) %s
+            RETURN id(n) as source, id(m) as target, id(r) as edge_id%s""" % (
+                node_label, node_label, edge_filter, ''.join(', r.%s' % objective for objective in objectives)))
+        columns = read_columns(result, [np.int64] * 3 + [np.float64] * len(objectives), batch_size)
+
+    # internal ids of the relationship ends to node positions
+    order = np.argsort(internal)
+    sources = order[np.searchsorted(internal, columns[0], sorter=order)]
+    targets = order[np.searchsorted(internal, columns[1], sorter=order)]
+    weights = {objective: np.where(np.isnan(values), math.inf, values)
+               for objective, values in zip(objectives, columns[3:])}
+    return CSRGraph.from_edges(node_ids, lat, lon, sources, targets, columns[2], weights, directed=True)
+
+
+def to_networkx(graph, objectives=None):
+    """networkx DiGraph view of a CSRGraph: nodes with id, lat and lon, edges with the objectives"""
+    import networkx as nx
+    objectives = list(graph.weights) if objectives is None else list(objectives)
+    G = nx.DiGraph()
+    node_ids = graph.node_ids.tolist()
+    G.add_nodes_from((node_id, {'id': node_id, 'lat': lat, 'lon': lon})
+                     for node_id, lat, lon in zip(node_ids, graph.lat.tolist(), graph.lon.tolist()))
+    sources = graph.edge_sources().tolist()
+    columns = [graph.weights[objective].tolist() for objective in objectives]
+    G.add_edges_from((node_ids[u], node_ids[v], dict(zip(objectives, values)))
+                     for u, v, *values in zip(sources, graph.indices.tolist(), *columns))
+    return G
@@ -0,0 +1,110 @@
+import math
+import heapq
+import numpy as np
+
+
+class LabelSetting:
+    """Pareto set of the routes between two nodes of a CSRGraph for several objectives.
+
+    Martins-style multi-criteria label setting: every label is a vector of objective costs
+    at a node with a pointer to its predecessor, labels are extended in lexicographic order
+    and a label is discarded as soon as another label at the same node dominates it. The
+    order uses the costs plus exact per-objective lower bounds to the target (one backward
+    Dijkstra per objective), so a label is also discarded when a route already found
+    dominates every completion of it, which keeps the search around the target.
+
+    With epsilon > 0 a label is discarded also when it is only epsilon-dominated (another
+    label is within a factor 1 + epsilon in every objective): the result is an
+    epsilon-approximation of the Pareto set and the number of labels per node is bounded,
+    which is what keeps city-scale searches in memory."""
+
+    def __init__(self, graph, objectives, epsilon=0.0):
+        self.graph = graph
+        self.objectives = list(objectives)
+        self.epsilon = epsilon
+        for objective in self.objectives:
+            graph.adjacency(objective)
+        self.costs = np.array([graph.weights[objective] for objective in self.objectives]).T.tolist()
+        self._reversed = None
+
+    def lower_bounds(self, t):
+        """costs of the best route from every node to t for each objective, shape (nodes, objectives)"""
+        if self._reversed is None:
+            self._reversed = self.graph.reversed()
+        return np.array([self._reversed.distances_from(t, objective) for objective in self.objectives]).T
+
+    def dominates(self, a, b):
+        """a is at least as good as b in every objective, up to the epsilon factor"""
+        factor = 1 + self.epsilon
+        return all(x <= y * factor for x, y in zip(a, b))
+
+    def pareto_paths(self, source, target):
+        """list of (objective costs, node ids) of the Pareto-optimal routes, in lexicographic order"""
+        s = self.graph.node_position(source)
+        t = self.graph.node_position(target)
+        bounds = self.lower_bounds(t)
+        if not np.all(np.isfinite(bounds[s])):
+            return []
+        bounds = bounds.tolist()
+        indptr, indices, _ = self.graph.adjacency(self.objectives[0])
+        costs = self.costs
+        n_objectives = len(self.objectives)
+
+        # labels: costs, node, predecessor label; alive[i] is False once label i is dominated
+        label_costs = [tuple([0.0] * n_objectives)]
+        label_node = [s]
+        label_parent = [-1]
+        alive = [True]
+        node_labels = {s: [0]}
+        solutions = []
+        heap = [(tuple(bounds[s]), 0)]
+        while heap:
+            _, i = heapq.heappop(heap)
+            if not alive[i]:
+                continue
+            u = label_node[i]
+            g = label_costs[i]
+            # routes found after the label was created may dominate it
+            if any(self.dominates(label_costs[j], tuple(x + y for x, y in zip(g, bounds[u]))) for j in solutions):
+                continue
+            if u == t:
+                solutions.append(i)
+                continue
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                h = bounds[v]
+                if h[0] == math.inf:
+                    continue
+                new = tuple(x + c for x, c in zip(g, costs[k]))
+                if math.inf in new:
+                    continue
+                estimate = tuple(x + y for x, y in zip(new, h))
+                if any(self.dominates(label_costs[j], estimate) for j in solutions):
+                    continue
+                labels = node_labels.setdefault(v, [])
+                if any(self.dominates(label_costs[j], new) for j in labels):
+                    continue
+                kept = []
+                for j in labels:
+                    if all(x <= y for x, y in zip(new, label_costs[j])):
+                        alive[j] = False
+                    else:
+                        kept.append(j)
+                label_costs.append(new)
+                label_node.append(v)
+                label_parent.append(i)
+                alive.append(True)
+                kept.append(len(label_costs) - 1)
+                node_labels[v] = kept
+                heapq.heappush(heap, (estimate, len(label_costs) - 1))
+
+        paths = []
+        for i in solutions:
+            nodes = []
+            j = i
+            while j != -1:
+                nodes.append(str(self.graph.node_ids[label_node[j]]))
+                j = label_parent[j]
+            nodes.reverse()
+            paths.append((label_costs[i], nodes))
+        return paths
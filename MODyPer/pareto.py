@@ -0,0 +1,115 @@
+from bisect import bisect_right
+import numpy as np
+
+
+def pareto_front(F):
+    """indices of the non-dominated rows of F (all objectives minimised), in increasing order.
+    Identical rows do not dominate each other. With 2 or 3 objectives the front is found with
+    a sweep in O(n log n), with more objectives by pairwise comparison."""
+    F = np.asarray(F, dtype=np.float64)
+    if len(F) == 0:
+        return np.zeros(0, dtype=np.int64)
+    unique, inverse = np.unique(F, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    # np.unique sorts the rows lexicographically: a row can only be dominated by a previous one
+    if unique.shape[1] == 1:
+        keep = np.arange(len(unique)) == 0
+    elif unique.shape[1] == 2:
+        previous_min = np.minimum.accumulate(np.concatenate([[np.inf], unique[:-1, 1]]))
+        keep = unique[:, 1] < previous_min
+    elif unique.shape[1] == 3:
+        keep = _sweep_3d(unique)
+    else:
+        keep = np.ones(len(unique), dtype=bool)
+        for i in range(len(unique)):
+            others = unique[:i]
+            keep[i] = not np.any(np.all(others <= unique[i], axis=1))
+    return np.flatnonzero(keep[inverse])
+
+
+def _sweep_3d(points):
+    """non-dominated flags of distinct points sorted lexicographically, with a staircase of the
+    second and third objectives of the points kept so far (second increasing, third decreasing)"""
+    keep = np.zeros(len(points), dtype=bool)
+    stair_f2 = []
+    stair_f3 = []
+    for i, (_, f2, f3) in enumerate(points.tolist()):
+        j = bisect_right(stair_f2, f2)
+        if j > 0 and stair_f3[j - 1] <= f3:
+            continue
+        keep[i] = True
+        # remove the steps dominated by the new point
+        if j > 0 and stair_f2[j - 1] == f2:
+            j -= 1
+        k = j
+        while k < len(stair_f2) and stair_f3[k] >= f3:
+            k += 1
+        stair_f2[j:k] = [f2]
+        stair_f3[j:k] = [f3]
+    return keep
+
+
+def non_dominated_sort(F):
+    """list of fronts (arrays of row indices): the first one is the Pareto front, the second one
+    the front of the remaining rows, and so on"""
+    F = np.asarray(F, dtype=np.float64)
+    remaining = np.arange(len(F))
+    fronts = []
+    while len(remaining):
+        front = remaining[pareto_front(F[remaining])]
+        fronts.append(front)
+        remaining = np.setdiff1d(remaining, front, assume_unique=True)
+    return fronts
+
+
+def normalize_objectives(F):
+    """objectives scaled to [0, 1], with the minimum and maximum of each one"""
+    F = np.asarray(F, dtype=np.float64)
+    F_min = F.min(axis=0)
+    F_max = F.max(axis=0)
+    return (F - F_min) / (F_max - F_min + 1e-9), F_min, F_max
+
+
+def hypervolume(F, ref_point):
+    """volume dominated by the rows of F and bounded by ref_point (rows not better than
+    ref_point in every objective are ignored), computed exactly by slicing on the last objective"""
+    F = np.asarray(F, dtype=np.float64)
+    ref_point = np.asarray(ref_point, dtype=np.float64)
+    F = F[np.all(F < ref_point, axis=1)]
+    if len(F) == 0:
+        return 0.0
+    F = F[pareto_front(F)]
+    if F.shape[1] == 1:
+        return float(ref_point[0] - F[:, 0].min())
+    if F.shape[1] == 2:
+        F = F[np.lexsort((F[:, 1], F[:, 0]))]
+        widths = np.diff(np.concatenate([F[:, 0], [ref_point[0]]]))
+        return float(np.sum(widths * (ref_point[1] - np.minimum.accumulate(F[:, 1]))))
+    # slabs between consecutive values of the last objective
+    F = F[np.argsort(F[:, -1], kind='stable')]
+    levels = np.concatenate([F[:, -1], [ref_point[-1]]])
+    volume = 0.0
+    for i in range(len(F)):
+        height = levels[i + 1] - levels[i]
+        if height > 0:
+            volume += height * hypervolume(F[:i + 1, :-1], ref_point[:-1])
+    return float(volume)
+
+
+def normalized_hypervolume(F, ref_point=None):
+    """hypervolume of the normalised objectives, by default with 1.1 as reference point"""
+    F_norm, _, _ = normalize_objectives(F)
+    if ref_point is None:
+        ref_point = np.ones(F_norm.shape[1]) * 1.1
+    return hypervolume(F_norm, ref_point), F_norm
+
+
+def select_by_preference(F_norm, user_pref):
+    """index of the row with the lowest weighted sum of the normalised objectives"""
+    return int(np.argmin(np.asarray(F_norm) @ np.asarray(user_pref, dtype=np.float64)))
+
+
+def select_by_ideal_point(F_norm):
+    """index of the row closest to the ideal point (the minimum of every normalised objective)"""
+    F_norm = np.asarray(F_norm)
+    return int(np.argmin(np.linalg.norm(F_norm - F_norm.min(axis=0), axis=1)))
@@ -0,0 +1,34 @@
+import numpy as np
+
+
+class PathScorer:
+    """Objective costs of many paths of a CSRGraph (see graph_loader.py) at once.
+
+    The objectives (plain or time-dependent weights such as pm25[1]) are the columns of a
+    matrix with one row per edge. Every path is mapped once to the positions of its edges
+    with CSRGraph.path_edges (between two nodes linked by several edges the shortest one
+    is used), then all the objectives are a gather of the rows of the matrix
+    followed by a sum over the edges of each path."""
+
+    def __init__(self, graph, objectives):
+        self.graph = graph
+        self.objectives = list(objectives)
+        for objective in self.objectives:
+            if objective not in graph.weights:
+                raise ValueError("Weight %s has not been loaded in the graph" % objective)
+        # shape (number of edges, number of objectives)
+        self.attributes = np.column_stack([graph.weights[objective] for objective in self.objectives])
+
+    def score_edges(self, edges, edge_path, n_paths):
+        """sums of the objectives over the edges of each path, shape (n_paths, number of objectives)"""
+        values = self.attributes[edges]
+        return np.column_stack([np.bincount(edge_path, weights=values[:, j], minlength=n_paths)
+                                for j in range(len(self.objectives))])
+
+    def score(self, paths):
+        """objective costs of the paths (lists of node ids), shape (len(paths), number of objectives).
+        The paths with a missing edge cost inf."""
+        edges, edge_path, missing = self.graph.path_edges(paths)
+        scores = self.score_edges(edges, edge_path, len(paths))
+        scores[missing] = np.inf
+        return scores
@@ -179,7 +179,8 @@ def main(args=None):
     raster_files = [path+filename.strip() for filename in interpolation_filename_list]
     print(raster_files)
 
-    edges = neo4jconn.get_edges_endpoints()
+    # the values are written only for the edges without them (e.g. the new edges of apply_osm_changes.py)
+    edges = neo4jconn.get_edges_endpoints(missing_property=options.pollutant_name)
     id_pairs = []
     
     mean_air_quality_values_all = []
@@ -219,6 +220,7 @@ def main(args=None):
     # result = aq.set_combined_weight(neo4jconn, options.pollutant_name)
     # print("Set " + str(result) + " combined weight properties")
 
+    neo4jconn.update_graph_version('add_airquality')
     neo4jconn.close_connection()
 
 
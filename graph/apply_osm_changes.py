@@ -0,0 +1,386 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import time
+import argparse
+import requests
+import numpy as np
+from utils.db_utils import Neo4jConnection
+from utils.graph_ingestion import (graph_tables, add_edge_attributes, property_rows, NEO4J_EARTH_RADIUS, OSMNX_EARTH_RADIUS,
+                                   COMPONENT_EXCLUDED_HIGHWAYS)
+from utils.osm_change import read_osc, is_route_way, change_graph, WAY_TAGS, NODE_TAGS
+
+
+# properties of the edges that come from OSM or are derived from it: the other ones are set by the
+# enrichment scripts (green area, air quality, crash risk...)
+BASE_EDGE_PROPERTIES = set(WAY_TAGS) | {'osmid', 'oneway', 'reversed', 'length', 'distance', 'geometry',
+                                        'foot_class', 'bike_class'}
+
+
+class OsmChangeUpdater:
+
+    def set_index(self, conn):
+        with conn.driver.session() as session:
+            session.run("""
+                        CREATE INDEX route_osmid_index IF NOT EXISTS FOR ()-[r:ROUTE]-() ON (r.osmid)
+                        """).consume()
+
+    def node_coordinates(self, conn, node_ids):
+        """{id: (lat, lon)} of the RouteNodes among node_ids"""
+        with conn.driver.session() as session:
+            result = session.run("""
+                                UNWIND $ids AS node_id
+                                MATCH (n:RouteNode {id: node_id})
+                                RETURN n.id, n.lat, n.lon""", ids=list(node_ids))
+            return {record[0]: (record[1], record[2]) for record in result}
+
+    def way_edges(self, conn, way_ids):
+        """{(source, target, way id): properties} of the ROUTE edges of the ways"""
+        # the ids are strings in the graphs imported from GraphML
+        ids = [int(way_id) for way_id in way_ids] + [str(way_id) for way_id in way_ids]
+        with conn.driver.session() as session:
+            result = session.run("""
+                                MATCH (a:RouteNode)-[r:ROUTE]->(b:RouteNode)
+                                WHERE r.osmid IN $ids
+                                RETURN a.id, b.id, toString(r.osmid), properties(r)""", ids=ids)
+            return {(record[0], record[1], record[2]): record[3] for record in result}
+
+    def delete_way_edges(self, conn, way_ids):
+        ids = [int(way_id) for way_id in way_ids] + [str(way_id) for way_id in way_ids]
+        with conn.driver.session() as session:
+            result = session.run("""
+                                MATCH ()-[r:ROUTE]->()
+                                WHERE r.osmid IN $ids
+                                DELETE r""", ids=ids)
+            return result.consume().counters.relationships_deleted
+
+    def remove_from_spatial_layer(self, conn, node_ids):
+        with conn.driver.session() as session:
+            session.run("""
+                        UNWIND $ids AS node_id
+                        MATCH (n:RouteNode {id: node_id})
+                        WHERE n.location is not null
+                        and (n.pedestrian_allowed_grafmove='yes' or n.cyclist_allowed_grafmove='yes')
+                        CALL spatial.removeNode('spatial_footbikenode', n) YIELD nodeId
+                        RETURN count(nodeId)""", ids=list(node_ids)).consume()
+
+    def add_to_spatial_layer(self, conn, node_ids):
+        with conn.driver.session() as session:
+            session.run("""
+                        UNWIND $ids AS node_id
+                        MATCH (n:RouteNode {id: node_id})
+                        WHERE n.location is not null
+                        and (n.pedestrian_allowed_grafmove='yes' or n.cyclist_allowed_grafmove='yes')
+                        WITH collect(n) as nodes
+                        CALL spatial.addNodes('spatial_footbikenode', nodes)
+                        YIELD count
+                        RETURN count""", ids=list(node_ids)).consume()
+
+    def delete_nodes(self, conn, node_ids):
+        self.remove_from_spatial_layer(conn, node_ids)
+        with conn.driver.session() as session:
+            result = session.run("""
+                                UNWIND $ids AS node_id
+                                MATCH (n:RouteNode {id: node_id})
+                                DETACH DELETE n""", ids=list(node_ids))
+            return result.consume().counters.nodes_deleted
+
+    def delete_orphans(self, conn, node_ids):
+        """delete the nodes among node_ids that are not on a way of the graph anymore, returns their ids"""
+        with conn.driver.session() as session:
+            result = session.run("""
+                                UNWIND $ids AS node_id
+                                MATCH (n:RouteNode {id: node_id})
+                                WHERE NOT (n)-[:ROUTE]-()
+                                RETURN n.id""", ids=list(node_ids))
+            orphans = [record[0] for record in result]
+        self.delete_nodes(conn, orphans)
+        return orphans
+
+    def update_nodes(self, conn, rows):
+        """coordinates and tags of existing nodes"""
+        with conn.driver.session() as session:
+            session.run("""
+                        UNWIND $rows AS row
+                        MATCH (n:RouteNode {id: row.id})
+                        SET n += row.properties,
+                        n.location = point({latitude: n.lat, longitude: n.lon, srid: 4326}),
+                        n.geometry = 'POINT(' + n.lon + ' ' + n.lat + ')'""", rows=rows).consume()
+
+    def create_nodes(self, conn, rows):
+        with conn.driver.session() as session:
+            result = session.run("""
+                                UNWIND $rows AS row
+                                MERGE (n:RouteNode {id: row.id})
+                                ON CREATE SET n = row, n.location = point({latitude: row.lat, longitude: row.lon, srid: 4326})""",
+                                 rows=rows)
+            return result.consume().counters.nodes_created
+
+    def create_edges(self, conn, rows):
+        with conn.driver.session() as session:
+            result = session.run("""
+                                UNWIND $rows AS row
+                                MATCH (a:RouteNode {id: row.source})
+                                MATCH (b:RouteNode {id: row.target})
+                                CREATE (a)-[r:ROUTE]->(b)
+                                SET r = row.properties""", rows=rows)
+            return result.consume().counters.relationships_created
+
+    def refresh_edges(self, conn, node_ids):
+        """distance, length and geometry of the edges of moved nodes; the properties set by the
+        enrichment scripts are removed, so that they are computed again for these edges"""
+        with conn.driver.session() as session:
+            session.run("""
+                        UNWIND $ids AS node_id
+                        MATCH (:RouteNode {id: node_id})-[r:ROUTE]-()
+                        WITH DISTINCT r
+                        WITH r, startNode(r) as a, endNode(r) as b
+                        SET r = apoc.map.clean(properties(r), [k IN keys(r) WHERE NOT k IN $base], [])
+                        SET r.distance = point.distance(a.location, b.location),
+                        r.length = point.distance(a.location, b.location) * $ratio,
+                        r.geometry = 'LINESTRING(' + a.lon + ' ' + a.lat + ', ' + b.lon + ' ' + b.lat + ')'""",
+                        ids=list(node_ids), base=sorted(BASE_EDGE_PROPERTIES),
+                        ratio=OSMNX_EARTH_RADIUS / NEO4J_EARTH_RADIUS).consume()
+
+    def components(self, conn):
+        """(internal node ids, component ids) of the connected components of the RouteNode graph
+        without the roads reserved to motor vehicles, as in create_footpath_graph.py"""
+        name = 'osc_filtered_graph'
+        conn.drop_projection(name)
+        with conn.driver.session() as session:
+            session.run("""
+                        CALL gds.graph.project.cypher($name,
+                        'MATCH (n:RouteNode) RETURN id(n) AS id',
+                        'MATCH (m)-[r:ROUTE]->(n) WHERE NOT r.highway IN $excluded
+                        RETURN id(n) AS source, type(r) AS type, id(m) AS target',
+                        {parameters: {excluded: $excluded}})""",
+                        name=name, excluded=COMPONENT_EXCLUDED_HIGHWAYS).consume()
+            result = session.run("""
+                                CALL gds.wcc.stream($name) YIELD nodeId, componentId
+                                RETURN nodeId, componentId""", name=name)
+            rows = np.array(result.values(), dtype=np.int64).reshape(-1, 2)
+        conn.drop_projection(name)
+        return rows[:, 0], rows[:, 1]
+
+    def set_foot_and_bike(self, conn, node_ids, outside_layer=()):
+        """allowed properties, labels and component of the nodes that joined or left the main
+        component (the largest one) after the change. A node can only join or leave it if its
+        component contains a changed node, so the nodes of the components of node_ids that are not
+        the main one lose the allowed properties, the labels and the spatial layer (except the nodes
+        in outside_layer, already removed from it), and the nodes of the main component that were not
+        allowed get them. Returns the ids of the nodes that joined."""
+        nodes, components = self.components(conn)
+        if len(nodes) == 0:
+            return []
+        values, counts = np.unique(components, return_counts=True)
+        main = values[np.argmax(counts)]
+        with conn.driver.session() as session:
+            touched = [record[0] for record in session.run("""
+                                UNWIND $ids AS node_id
+                                MATCH (n:RouteNode {id: node_id})
+                                RETURN id(n)""", ids=list(node_ids))]
+            not_allowed = [record[0] for record in session.run("""
+                                MATCH (n:RouteNode)
+                                WHERE n.pedestrian_allowed_grafmove IS NULL OR n.pedestrian_allowed_grafmove <> 'yes'
+                                RETURN id(n)""")]
+            record = session.run("""
+                                MATCH (n:FootNode) WHERE n.componentId IS NOT NULL
+                                RETURN n.componentId LIMIT 1""").single()
+            component_id = record[0] if record else int(main)
+
+            left_components = np.setdiff1d(components[np.isin(nodes, touched)], [main])
+            candidates = nodes[np.isin(components, left_components)]
+            left = [record[0] for record in session.run("""
+                                UNWIND $ids AS internal_id
+                                MATCH (n:RouteNode) WHERE id(n) = internal_id
+                                AND (n.pedestrian_allowed_grafmove IS NULL OR n.pedestrian_allowed_grafmove <> 'no')
+                                RETURN n.id""", ids=candidates.tolist())]
+            # while they are still allowed, so that they are found in the layer
+            self.remove_from_spatial_layer(conn, set(left) - set(outside_layer))
+            # the other components have no id among the ones written when the graph was built
+            session.run("""
+                        UNWIND $ids AS node_id
+                        MATCH (n:RouteNode {id: node_id})
+                        SET n.pedestrian_allowed_grafmove='no', n.cyclist_allowed_grafmove='no'
+                        REMOVE n:FootNode:BikeNode, n.componentId""", ids=left).consume()
+
+            joined = np.intersect1d(nodes[components == main], not_allowed)
+            result = session.run("""
+                                UNWIND $ids AS internal_id
+                                MATCH (n:RouteNode) WHERE id(n) = internal_id
+                                SET n.pedestrian_allowed_grafmove='yes', n.cyclist_allowed_grafmove='yes',
+                                n.componentId=$component, n:FootNode:BikeNode
+                                RETURN n.id""", ids=joined.tolist(), component=component_id)
+            return [record[0] for record in result]
+
+    def set_street_count(self, conn, node_ids):
+        with conn.driver.session() as session:
+            session.run("""
+                        UNWIND $ids AS node_id
+                        MATCH (n:RouteNode {id: node_id})
+                        SET n.street_count = size(apoc.coll.toSet([(n)-[:ROUTE]-(m) | id(m)]))""",
+                        ids=list(node_ids)).consume()
+
+    def set_green_area(self, conn, node_ids):
+        """green area weight of the edges of the nodes without it, as GreenArea.set_weight, if the
+        green areas have been integrated in the graph"""
+        with conn.driver.session() as session:
+            if session.run("""
+                            MATCH ()-[r:ROUTE]->() WHERE r.green_area is not null RETURN r LIMIT 1
+                            """).single() is None:
+                return
+            session.run("""
+                        UNWIND $ids AS node_id
+                        MATCH (:RouteNode {id: node_id})-[r:ROUTE]-()
+                        WITH DISTINCT r
+                        WITH r, startNode(r) as a, endNode(r) as b
+                        WHERE r.green_area is null
+                        SET r.green_area = case when a.green_area = 'yes' and b.green_area = 'yes' then 100
+                                                when a.green_area = 'yes' or b.green_area = 'yes' then 50
+                                                else 0 end
+                        SET r.green_area_weight = r.distance / (r.green_area/100 + 1)""",
+                        ids=list(node_ids)).consume()
+
+
+def overpass_coordinates(node_ids, url='http://overpass-api.de/api/interpreter', timeout=180):
+    """{id: (lat, lon)} of OSM nodes downloaded from the Overpass API, RuntimeError if a request
+    fails or does not answer within timeout seconds"""
+    node_ids = list(node_ids)
+    coordinates = {}
+    for start in range(0, len(node_ids), 1000):
+        query = "[out:json]; node(id:%s); out;" % ','.join(node_ids[start:start + 1000])
+        try:
+            result = requests.get(url, params={'data': query}, timeout=timeout)
+            result.raise_for_status()
+            elements = result.json()['elements']
+        except (requests.RequestException, ValueError, KeyError) as e:
+            raise RuntimeError("Overpass request for the missing node coordinates failed: %s" % e) from e
+        for element in elements:
+            coordinates[str(element['id'])] = (element['lat'], element['lon'])
+    return coordinates
+
+
+def add_options():
+    parser = argparse.ArgumentParser(description='Update the graph with an OSM change file.')
+    parser.add_argument('--neo4jURL', '-n', dest='neo4jURL', type=str,
+                        help="""Insert the address of the local neo4j instance. For example: neo4j://localhost:7687""",
+                        required=True)
+    parser.add_argument('--neo4juser', '-u', dest='neo4juser', type=str,
+                        help="""Insert the name of the user of the local neo4j instance.""",
+                        required=True)
+    parser.add_argument('--neo4jpwd', '-p', dest='neo4jpwd', type=str,
+                        help="""Insert the password of the local neo4j instance.""",
+                        required=True)
+    parser.add_argument('--change_filename', '-c', dest='change_filename', type=str,
+                        help="""Insert the name of the OSM change file (.osc).""",
+                        required=True)
+    parser.add_argument('--overpass', '-o', dest='overpass', action='store_true',
+                        help="""Download from the Overpass API the coordinates of the nodes of the changed ways
+                        that are neither in the change file nor in the graph.""",
+                        required=False, default=False)
+    return parser
+
+
+def main(args=None):
+    argParser = add_options()
+    options = argParser.parse_args(args=args)
+    neo4jconn = Neo4jConnection(options.neo4jURL, options.neo4juser, options.neo4jpwd)
+    neo4jconn.open_connection()
+
+    updater = OsmChangeUpdater()
+    updater.set_index(neo4jconn)
+
+    nodes, ways = read_osc(options.change_filename)
+    print("Changed nodes: %d, changed ways: %d" % (len(nodes), len(ways)))
+
+    # state of the graph before the change
+    old_edges = updater.way_edges(neo4jconn, ways)
+    route_ways = {way_id: (node_ids, tags) for way_id, (action, node_ids, tags) in ways.items()
+                  if action != 'delete' and is_route_way(tags)}
+    way_nodes = {node_id for node_ids, _ in route_ways.values() for node_id in node_ids}
+    old_nodes = {node_id for source, target, _ in old_edges for node_id in (source, target)}
+    existing = updater.node_coordinates(neo4jconn, way_nodes | old_nodes | set(nodes))
+
+    deleted = [node_id for node_id, (action, _, _, _) in nodes.items() if action == 'delete' and node_id in existing]
+    coordinates = dict(existing)
+    for node_id, (action, lat, lon, _) in nodes.items():
+        if action != 'delete' and lat is not None:
+            coordinates[node_id] = (lat, lon)
+    for node_id in deleted:
+        coordinates.pop(node_id)
+    moved = [node_id for node_id in existing if node_id in coordinates and node_id in nodes and
+             (abs(coordinates[node_id][0] - existing[node_id][0]) > 1e-9 or
+              abs(coordinates[node_id][1] - existing[node_id][1]) > 1e-9)]
+    # downloaded before any change, so that a failed request leaves the graph untouched
+    missing = way_nodes - set(coordinates)
+    if missing and options.overpass:
+        coordinates.update(overpass_coordinates(missing))
+
+    # edges of the changed ways and deleted nodes
+    count = updater.delete_way_edges(neo4jconn, ways)
+    print("Edges of the changed ways deleted: " + str(count))
+    count = updater.delete_nodes(neo4jconn, deleted)
+    print("Nodes deleted: " + str(count))
+
+    # moved nodes and new tags of the existing nodes
+    updater.remove_from_spatial_layer(neo4jconn, moved)
+    rows = []
+    for node_id, (action, _, _, tags) in nodes.items():
+        if action == 'modify' and node_id in existing and node_id not in deleted:
+            lat, lon = coordinates[node_id]
+            properties = {name: tags.get(name) for name in NODE_TAGS}
+            properties.update({'x': lon, 'y': lat, 'lat': lat, 'lon': lon, 'latitude': lat, 'longitude': lon})
+            rows.append({'id': node_id, 'properties': properties})
+    updater.update_nodes(neo4jconn, rows)
+    print("Nodes moved: %d, nodes updated: %d" % (len(moved), len(rows)))
+
+    # new edges of the changed ways, with the properties of the enrichment scripts of the edges
+    # that are still there and whose nodes have not moved
+    G, missing_segments = change_graph(route_ways, coordinates, {node_id: tags for node_id, (_, _, _, tags) in nodes.items()})
+    if missing_segments:
+        print("Segments without the coordinates of their nodes (use --overpass): " + str(len(missing_segments)))
+    created = []
+    if G.number_of_nodes():
+        node_table, edge_table = graph_tables(G)
+        add_edge_attributes(node_table, edge_table)
+        new_nodes = node_table[~node_table['id'].isin(list(existing)).to_numpy()]
+        created = new_nodes['id'].tolist()
+        count = updater.create_nodes(neo4jconn, property_rows(new_nodes))
+        print("Nodes created: " + str(count))
+
+        moved_set = set(moved)
+        rows = []
+        for row in property_rows(edge_table):
+            source, target = row.pop('source'), row.pop('target')
+            old = old_edges.get((source, target, str(row['osmid'])))
+            properties = {}
+            if old is not None and source not in moved_set and target not in moved_set:
+                properties = {name: value for name, value in old.items() if name not in BASE_EDGE_PROPERTIES}
+            properties.update(row)
+            rows.append({'source': source, 'target': target, 'properties': properties})
+        count = updater.create_edges(neo4jconn, rows)
+        print("Edges created: " + str(count))
+
+    # derived properties of the touched nodes and edges and of their neighbours
+    updater.refresh_edges(neo4jconn, moved)
+    touched = (way_nodes | old_nodes | set(moved)) - set(deleted)
+    orphans = updater.delete_orphans(neo4jconn, old_nodes - way_nodes - set(deleted))
+    print("Nodes without edges deleted: " + str(len(orphans)))
+    touched -= set(orphans)
+    joined = updater.set_foot_and_bike(neo4jconn, touched, moved)
+    print("Nodes joining the main component: %d" % len(joined))
+    updater.set_street_count(neo4jconn, touched)
+    updater.set_green_area(neo4jconn, touched)
+    updater.add_to_spatial_layer(neo4jconn, set(created) | set(moved) | set(joined))
+    print("Derived properties updated for %d nodes and their edges" % len(touched))
+
+    neo4jconn.update_graph_version('apply_osm_changes')
+    neo4jconn.close_connection()
+
+    return 0
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    main()
+    print("Execution time: %s seconds ---" % (time.time() - start_time))
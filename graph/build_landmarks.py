@@ -0,0 +1,67 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import time
+import argparse
+from utils.db_utils import Neo4jConnection
+from utils.csr_graph import CSRGraph
+from utils.landmarks import LandmarkIndex
+
+
+DEFAULT_WEIGHTS = 'distance green_area_weight'
+
+
+def add_options():
+    parser = argparse.ArgumentParser(description='Selection of the landmarks of the graph for the A* searches (ALT).')
+    parser.add_argument('--neo4jURL', '-n', dest='neo4jURL', type=str,
+                        help="""Insert the address of the local neo4j instance. For example: neo4j://localhost:7687""",
+                        required=True)
+    parser.add_argument('--neo4juser', '-u', dest='neo4juser', type=str,
+                        help="""Insert the name of the user of the local neo4j instance.""",
+                        required=True)
+    parser.add_argument('--neo4jpwd', '-p', dest='neo4jpwd', type=str,
+                        help="""Insert the password of the local neo4j instance.""",
+                        required=True)
+    parser.add_argument('--node_label', '-l', dest='node_label', type=str, choices=['FootNode', 'BikeNode'],
+                        help="""Insert the label of the nodes of the graph to preprocess.""",
+                        required=False, default='FootNode')
+    parser.add_argument('--weights', '-w', dest='weights', type=str,
+                        help="""Insert the space-separated weights for which the landmark distances are stored, the first one is used to select the landmarks (default: distance and green_area_weight). Time-dependent weights are selected with the index of the time interval, for example: "distance green_area_weight pm25_per_meter[1] crash_risk_per_meter[1]".""",
+                        required=False)
+    parser.add_argument('--num_landmarks', '-nl', dest='num_landmarks', type=int,
+                        help="""Insert the number of landmarks.""",
+                        required=False, default=16)
+    parser.add_argument('--output_dir', '-o', dest='output_dir', type=str,
+                        help="""Insert the directory where to store the landmark index (default: the import folder of neo4j, next to the graph).""",
+                        required=False)
+    return parser
+
+
+def main(args=None):
+    argParser = add_options()
+    options = argParser.parse_args(args=args)
+    neo4jconn = Neo4jConnection(options.neo4jURL, options.neo4juser, options.neo4jpwd)
+    neo4jconn.open_connection()
+
+    output_dir = options.output_dir
+    if output_dir is None:
+        output_dir = neo4jconn.get_path()[0][0] + '/' + neo4jconn.get_import_folder_name()[0][0]
+
+    weights = (options.weights or DEFAULT_WEIGHTS).split()
+    graph = CSRGraph.from_neo4j(neo4jconn, weights, node_label=options.node_label)
+    graph.version = neo4jconn.get_graph_version()
+    print("Graph loaded: " + str(graph.n_nodes) + " nodes, " + str(graph.n_edges) + " edges")
+    neo4jconn.close_connection()
+
+    landmarks = LandmarkIndex.build(graph, weights, options.num_landmarks)
+    filename = os.path.join(output_dir, 'landmarks_%s.npz' % options.node_label)
+    landmarks.save(filename)
+    print("Landmarks " + str(graph.node_ids[landmarks.landmarks].tolist()) + " stored in " + filename)
+
+    return 0
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    main()
+    print("Execution time: %s seconds ---" % (time.time() - start_time))
@@ -2,10 +2,21 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import time
+import math
+import json
 import osmnx as ox
 import argparse
+from multiprocessing import Pool
 from neo4j import GraphDatabase
 from utils.db_utils import Neo4jConnection
+from utils.graph_ingestion import (graph_tables, add_edge_attributes, stitch_tables, write_tables, write_admin_csv, class_case,
+                                   FOOT_CLASS_RULES, BIKE_CLASS_RULES, OSMNX_EARTH_RADIUS, COMPONENT_EXCLUDED_HIGHWAYS)
+
+
+# class of the ROUTE relationships r for pedestrians and cyclists, from 1 (dedicated) to 5
+FOOT_CLASS = class_case(FOOT_CLASS_RULES)
+BIKE_CLASS = class_case(BIKE_CLASS_RULES)
+
 
 class FootPathGraph:
 
@@ -20,7 +31,7 @@ class FootPathGraph:
         with conn.driver.session() as session:
             result = session.run("""
                                 CALL apoc.periodic.iterate(
-                                  "MATCH (n) RETURN n",
+                                  "MATCH (n) WHERE n.id IS NOT NULL AND n.x IS NOT NULL RETURN n",
                                   "SET n:RouteNode", 
                                   {batchSize:1000, iterateList:true}
                                 )
@@ -35,7 +46,7 @@ class FootPathGraph:
         with conn.driver.session() as session:
             result = session.run("""
                                 CALL apoc.periodic.iterate(
-                                  "MATCH (n) RETURN n",
+                                  "MATCH (n) WHERE n.id IS NOT NULL AND n.x IS NOT NULL RETURN n",
                                   "SET n.location = point({latitude: tofloat(n.y), longitude: tofloat(n.x), srid:4326}), 
                                   n.lat = tofloat(n.y), 
                                   n.lon = tofloat(n.x), 
@@ -80,7 +91,7 @@ class FootPathGraph:
     def set_index(self, conn):
         with conn.driver.session() as session:
             result = session.run("""
-                                    CREATE INDEX osmnode_id_index FOR (n:RouteNode) ON (n.id)
+                                    CREATE INDEX osmnode_id_index IF NOT EXISTS FOR (n:RouteNode) ON (n.id)
                                 """)
             result = session.run("""
                                     CREATE POINT INDEX osmnode_location_index FOR (n:RouteNode) ON (n.location)
@@ -132,11 +143,9 @@ class FootPathGraph:
                                 'filtered_graph',
                                 'match (n:RouteNode) return id(n) as id',
                                 'match (m)-[r:ROUTE]->(n) where 
-                                not r.highway in ["motorway", "motorway_link", "motorway_junction", 
-                                "trunk", "trunk_link", "primary", "primary_link", "secondary", "secondary_link", 
-                                "busway", "bus_guideway", "bus_stop", 
-                                "escape", "raceway", "corridor", "services", "emergency_bay", "proposed", "construction"]
-                                return id(n) as source, type(r) as type, id(m) as target') """)
+                                not r.highway in %s
+                                return id(n) as source, type(r) as type, id(m) as target') """%(
+                                    json.dumps(COMPONENT_EXCLUDED_HIGHWAYS)))
                                 
             result = session.run("""
                                 CALL gds.wcc.write('filtered_graph', { writeProperty: 'componentId' })
@@ -186,63 +195,135 @@ class FootPathGraph:
             
                 result = session.run("""CALL apoc.periodic.iterate(
                                     "match (:FootNode)-[r:ROUTE]-(:FootNode) return r, 
-                                    case 
-                                    when r.highway in ['pedestrian', 'footway', 'steps'] then 1
-                                    when r.highway='living_street' and r.foot='yes' and r.segregated='yes' then 1
-                                    when r.highway='path' and r.foot='yes' and r.segregated='yes' then 1
-                                    when r.highway='track' and r.foot='yes' and r.segregated='yes' then 1
-                                    when r.foot='designated' then 1
-                                    when r.footway='sidewalk' then 1
-                                    when r.sidewalk in ['left', 'right', 'both', 'yes', 'lane', 'separate'] then 1
-                                    when r.foot='yes' then 2
-                                    when r.highway='footway' and r.bicycle='yes' then 2
-                                    when r.bicycle='designated' and r.segregated='no' then 2
-                                    when r.highway in ['residential', 'unclassified', 'path', 'track', 'service', 'living_street'] then 2
-                                    when r.highway='living_street' and r.foot='yes' and r.segregated='no' then 2
-                                    when r.highway='path' and r.foot='yes' and r.segregated='no' then 2
-                                    when r.highway='track' and r.foot='yes' and r.segregated='no' then 2
-                                    when toInteger(r.maxspeed)<=30 then 2
-                                    when toInteger(r.maxspeed)>30 and toInteger(r.maxspeed)<=50 then 3
-                                    when toInteger(r.maxspeed)>50 then 4
-                                    else 5
-                                    end as class",
+                                    %s as class",
                                     "set r.foot_class=class", 
                                     {batchSize:1000, iterateList:true}
                                     )
                                     YIELD batches, total
-                                    RETURN batches, total;""")
+                                    RETURN batches, total;"""%(FOOT_CLASS))
                                     
                                     
                 result = session.run("""CALL apoc.periodic.iterate(
                                     "match (:BikeNode)-[r:ROUTE]-(:BikeNode) return r, 
-                                    case 
-                                    when r.highway='cycleway' then 1
-                                    when r.cycleway='track' then 1
-                                    when r.cycleway_right='track' then 1
-                                    when r.cycleway_left='track' then 1
-                                    when r.cycleway_both='track' then 1
-                                    when r.bicycle='use_sidepath' then 1
-                                    when r.bicycle='designated' and r.segregated='yes' then 1
-                                    when r.cycleway='lane' then 2
-                                    when r.cycleway_left='lane' then 2
-                                    when r.cycleway_right='lane' then 2
-                                    when r.cycleway_both='lane' then 2
-                                    when r.cycleway='share_busway' then 2
-                                    when r.cycleway_left='share_busway' then 2
-                                    when r.cycleway_right='share_busway' then 2
-                                    when r.highway='footway' and r.bicycle='yes' then 2
-                                    when r.highway in ['residential', 'unclassified', 'path', 'track', 'service', 'living_street'] then 2
-                                    when r.bicycle='designated' and r.segregated='no' then 2
-                                    when toInteger(r.maxspeed)<=30 then 2
-                                    when toInteger(r.maxspeed)>30 and toInteger(r.maxspeed)<=50 then 3
-                                    when toInteger(r.maxspeed)>50 then 4
-                                    else 5
-                                    end as class",
+                                    %s as class",
                                     "set r.bike_class=class", 
                                     {batchSize:1000, iterateList:true}
                                     )
                                     YIELD batches, total
+                                    RETURN batches, total;"""%(BIKE_CLASS))
+
+    # fused passes: each one reads every node or edge once and sets all the properties derived from it
+
+    def set_node_properties(self, conn):
+        """set_label and set_location in a single pass over the nodes. As in those passes, only the
+        imported OSM nodes (with id and x) are matched, not the GraphVersion stamp of a previous build"""
+        with conn.driver.session() as session:
+            result = session.run("""
+                                CALL apoc.periodic.iterate(
+                                  "MATCH (n) WHERE n.id IS NOT NULL AND n.x IS NOT NULL RETURN n, tofloat(n.y) as lat, tofloat(n.x) as lon",
+                                  "SET n:RouteNode, 
+                                  n.location = point({latitude: lat, longitude: lon, srid:4326}), 
+                                  n.lat = lat, 
+                                  n.lon = lon, 
+                                  n.latitude = lat, 
+                                  n.longitude = lon, 
+                                  n.geometry='POINT(' + lon + ' ' + lat +')'", 
+                                  {batchSize:10000, iterateList:true, parallel:true}
+                                )
+                                YIELD batches, total
+                                RETURN batches, total;
+                                """)
+            return result.values()
+
+    def set_edge_properties(self, conn):
+        """set_distance and set_edge_geometry in a single pass over the directed edges"""
+        with conn.driver.session() as session:
+            result = session.run("""CALL apoc.periodic.iterate(
+                                    "MATCH (a:RouteNode)-[r:ROUTE]->(b:RouteNode) where a.lat is not null and b.lat is not null 
+                                    return a, b, r",
+                                    "set r.distance=point.distance(a.location, b.location), 
+                                    r.geometry='LINESTRING(' + a.lon + ' ' + a.lat + ', ' + b.lon + ' ' + b.lat + ')'", 
+                                    {batchSize:10000, iterateList:true, parallel:true}
+                                    )
+                                    YIELD batches, total
                                     RETURN batches, total;""")
+            return result.values()
+
+    def set_foot_and_bike_fused(self, conn, compId):
+        """set_foot_and_bike in a single pass: the allowed properties and the labels of each node"""
+        with conn.driver.session() as session:
+            result = session.run("""CALL apoc.periodic.iterate(
+                                "match (n:RouteNode) return n, case when n.componentId=%s then 'yes' else 'no' end as value",
+                                "set n.pedestrian_allowed_grafmove=value, n.cyclist_allowed_grafmove=value 
+                                foreach (_ in case when value='yes' then [1] else [] end | set n:FootNode:BikeNode)", 
+                                {batchSize:10000, iterateList:true, parallel:true}
+                                )
+                                YIELD batches, total
+                                RETURN batches, total;"""%(compId))
+            return result.values()
+
+    def classify_roads_fused(self, conn):
+        """classify_roads in a single pass over the directed edges, with both classes"""
+        with conn.driver.session() as session:
+            result = session.run("""CALL apoc.periodic.iterate(
+                                "match (a:RouteNode)-[r:ROUTE]->(b:RouteNode) 
+                                where (a:FootNode and b:FootNode) or (a:BikeNode and b:BikeNode) 
+                                return r, a:FootNode and b:FootNode as foot, a:BikeNode and b:BikeNode as bike",
+                                "set r.foot_class = case when foot then %s else r.foot_class end, 
+                                r.bike_class = case when bike then %s else r.bike_class end", 
+                                {batchSize:10000, iterateList:true, parallel:true}
+                                )
+                                YIELD batches, total
+                                RETURN batches, total;"""%(FOOT_CLASS, BIKE_CLASS))
+            return result.values()
+
+
+def download_graph(lat, lon, dist):
+    """osmnx graph of all the ways in the square of side 2 * dist meters around the point"""
+    return ox.graph_from_point((lat, lon),
+                               dist=int(dist),
+                               dist_type='bbox',
+                               simplify=False,
+                               network_type='all',
+                               retain_all=True
+                               )
+
+
+def tile_centers(lat, lon, dist, tiles):
+    """centres of the tiles x tiles square tiles of side 2 * dist / tiles meters that cover the square
+    of side 2 * dist meters around the point, as osmnx computes it"""
+    half = dist / tiles
+    offsets = [-dist + half * (2 * i + 1) for i in range(tiles)]
+    return [(lat + math.degrees(dy / OSMNX_EARTH_RADIUS),
+             lon + math.degrees(dx / (OSMNX_EARTH_RADIUS * math.cos(math.radians(lat)))))
+            for dy in offsets for dx in offsets]
+
+
+def build_tile(task):
+    """node and edge tables, with the edge attributes, of the tile of half side dist around the point"""
+    lat, lon, dist = task
+    nodes, edges = graph_tables(download_graph(lat, lon, dist))
+    add_edge_attributes(nodes, edges)
+    return nodes, edges
+
+
+def build_tiled_tables(lat, lon, dist, tiles, overlap=100, workers=1):
+    """node and edge tables of the area built tile by tile in a pool of processes. The tiles overlap by
+    overlap meters, so that the edges that cross the border of a tile are complete in one of them,
+    and they are stitched together by OSM id and cropped to the area."""
+    tasks = [(tile_lat, tile_lon, dist / tiles + overlap) for tile_lat, tile_lon in tile_centers(lat, lon, dist, tiles)]
+    if workers <= 1:
+        tables = [build_tile(task) for task in tasks]
+    else:
+        with Pool(workers) as pool:
+            tables = pool.map(build_tile, tasks)
+    nodes, edges = stitch_tables(tables)
+    # the outer tiles cross the border of the area by overlap meters
+    inside = ((nodes['lat'] - lat).abs() <= math.degrees(dist / OSMNX_EARTH_RADIUS)) & \
+             ((nodes['lon'] - lon).abs() <= math.degrees(dist / (OSMNX_EARTH_RADIUS * math.cos(math.radians(lat)))))
+    nodes = nodes[inside.to_numpy()].reset_index(drop=True)
+    kept = edges['source'].isin(nodes['id']) & edges['target'].isin(nodes['id'])
+    return nodes, edges[kept.to_numpy()].reset_index(drop=True)
 
 
 def add_options():
@@ -268,41 +349,95 @@ def add_options():
     parser.add_argument('--nameFile', '-f', dest='file_name', type=str,
                         help="""Insert the name of the .graphml file to store the graph.""",
                         required=False, default='graph.graphml')
+    parser.add_argument('--ingestion', '-i', dest='ingestion', type=str,
+                        choices=['graphml', 'unwind', 'csv', 'loaded'],
+                        help="""How the graph is loaded into Neo4j: 'graphml' (file imported with apoc.import.graphml),
+                        'unwind' (typed node and edge tables written with UNWIND batches), 'csv' (node and edge
+                        files for neo4j-admin import are written in the import folder, then the script stops) or
+                        'loaded' (the graph has already been loaded from those files, only the following steps run).""",
+                        required=False, default='graphml')
+    parser.add_argument('--batch_size', '-bs', dest='batch_size', type=int,
+                        help="""Number of nodes or edges written by each UNWIND query.""",
+                        required=False, default=10000)
+    parser.add_argument('--post_processing', '-pp', dest='post_processing', type=str,
+                        choices=['separate', 'fused'],
+                        help="""'separate' runs one pass over the graph for each derived property, 'fused' computes
+                        all the properties of the nodes (or of the edges) in a single parallel pass.""",
+                        required=False, default='separate')
+    parser.add_argument('--tiles', '-t', dest='tiles', type=int,
+                        help="""Build the graph in tiles x tiles tiles (with --ingestion unwind or csv), for large areas.""",
+                        required=False, default=1)
+    parser.add_argument('--tile_overlap', '-to', dest='tile_overlap', type=float,
+                        help="""Overlap (in meters) between adjacent tiles, longer than the edges that cross their border.""",
+                        required=False, default=100)
+    parser.add_argument('--workers', '-w', dest='workers', type=int,
+                        help="""Number of processes that build the tiles in parallel.""",
+                        required=False, default=1)
     return parser
 
 
 def main(args=None):
     argParser = add_options()
     options = argParser.parse_args(args=args)
+    if options.tiles > 1 and options.ingestion not in ('unwind', 'csv'):
+        argParser.error("--tiles requires --ingestion unwind or csv")
     
     neo4jconn = Neo4jConnection(options.neo4jURL, options.neo4juser, options.neo4jpwd)
     neo4jconn.open_connection()
-    path = neo4jconn.get_path()[0][0] + '/' + neo4jconn.get_import_folder_name()[0][0] + '/' + options.file_name
-    print(path)
+    import_folder = neo4jconn.get_path()[0][0] + '/' + neo4jconn.get_import_folder_name()[0][0]
+    
+    if options.ingestion == 'graphml':
+        G = download_graph(options.lat, options.lon, options.dist)
+    elif options.ingestion in ('unwind', 'csv'):
+        # typed tables: the nodes and edges are written with their location, distance, geometry and classes
+        if options.tiles > 1:
+            nodes, edges = build_tiled_tables(options.lat, options.lon, options.dist, options.tiles,
+                                              options.tile_overlap, options.workers)
+        else:
+            nodes, edges = graph_tables(download_graph(options.lat, options.lon, options.dist))
+            add_edge_attributes(nodes, edges)
+        print("Nodes: %d, Edges: %d" % (len(nodes), len(edges)))
     
-    G = ox.graph_from_point((options.lat, options.lon),
-                            dist=int(options.dist),
-                            dist_type='bbox',
-                            simplify=False,
-                            network_type='all',
-                            retain_all=True
-                            )
-    ox.save_graphml(G, path)
+    if options.ingestion == 'csv':
+        nodes_file, edges_file = write_admin_csv(nodes, edges, import_folder)
+        print("Stop the database and load the graph with:")
+        print("neo4j-admin database import full --nodes=%s --relationships=%s neo4j" % (nodes_file, edges_file))
+        print("then run this script again with --ingestion loaded")
+        neo4jconn.close_connection()
+        return 0
     
     neo4jconn.generate_spatial_layer('spatial_footbikenode')
      
     graph = FootPathGraph()
-    graph.create_graph(neo4jconn, options.file_name)
-    print("Graph created")
-    
-    graph.set_label(neo4jconn)
-    print("Label set")
-    
-    graph.set_location(neo4jconn)
-    print("Location set")
+    if options.ingestion == 'graphml':
+        path = import_folder + '/' + options.file_name
+        print(path)
+        ox.save_graphml(G, path)
+        
+        graph.create_graph(neo4jconn, options.file_name)
+        print("Graph created")
+        
+        if options.post_processing == 'fused':
+            graph.set_node_properties(neo4jconn)
+            print("Label and location set")
+        else:
+            graph.set_label(neo4jconn)
+            print("Label set")
+            
+            graph.set_location(neo4jconn)
+            print("Location set")
+            
+            graph.set_distance(neo4jconn)
+            print("Distance set")
+    elif options.ingestion == 'unwind':
+        write_tables(neo4jconn, nodes, edges, options.batch_size)
+        print("Graph created")
     
-    graph.set_distance(neo4jconn)
-    print("Distance set")
+    # with the tables the edge attributes are computed before the import
+    computed = options.ingestion != 'graphml'
+    if options.post_processing == 'fused' and not computed:
+        graph.set_edge_properties(neo4jconn)
+        print("Distance and edge geometry set")
     
     graph.set_index(neo4jconn)
     print("Index set")
@@ -316,18 +451,27 @@ def main(args=None):
     
     first_componentId = ccomponents[0][0]
     
-    graph.set_foot_and_bike(neo4jconn, first_componentId)
+    if options.post_processing == 'fused':
+        graph.set_foot_and_bike_fused(neo4jconn, first_componentId)
+    else:
+        graph.set_foot_and_bike(neo4jconn, first_componentId)
     print("Set is_pedestrian_grafmove set")
     
-    graph.classify_roads(neo4jconn)
-    print("Roads classified")
+    if not computed:
+        if options.post_processing == 'fused':
+            graph.classify_roads_fused(neo4jconn)
+        else:
+            graph.classify_roads(neo4jconn)
+        print("Roads classified")
 
     graph.import_nodes_in_spatial_layer(neo4jconn)
     print("FootNodes imported in spatial layer")
     
-    graph.set_edge_geometry(neo4jconn)
-    print("Set edge geometry")
+    if options.post_processing != 'fused' and not computed:
+        graph.set_edge_geometry(neo4jconn)
+        print("Set edge geometry")
     
+    neo4jconn.update_graph_version('create_footpath_graph')
     neo4jconn.close_connection()
 
     return 0
@@ -100,7 +100,8 @@ def main(args=None):
 
     cr = CrashRisk()
 
-    edges = neo4jconn.get_edges_endpoints()
+    # the values are written only for the edges without them (e.g. the new edges of apply_osm_changes.py)
+    edges = neo4jconn.get_edges_endpoints(missing_property='crash_risk')
     id_pairs = []
     crash_risk_values = []
     area_values = []
@@ -190,9 +191,10 @@ def main(args=None):
     print("Set " + str(result) + " crash risk properties")
 
     print("--------------------------------")
-    print("No accidents found for " + str(empty) + " edges (" + str(empty/len(edges)*100) + "%)")
-    print("At least one accident found for " + str(non_empty) + " edges (" + str(non_empty/len(edges)*100) + "%)")
+    print("No accidents found for " + str(empty) + " edges (" + str(empty/max(len(edges), 1)*100) + "%)")
+    print("At least one accident found for " + str(non_empty) + " edges (" + str(non_empty/max(len(edges), 1)*100) + "%)")
     
+    neo4jconn.update_graph_version('find_crash_risk')
     neo4jconn.close_connection()
 
 
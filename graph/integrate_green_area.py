@@ -184,6 +184,7 @@ def main(args=None):
     greenarea.set_weight(neo4jconn)
     
     
+    neo4jconn.update_graph_version('integrate_green_area')
     neo4jconn.close_connection()
     
 
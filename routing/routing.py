@@ -8,26 +8,43 @@ from neo4j import GraphDatabase
 # import json
 import argparse
 import time
+from multiprocessing import Pool
 import numpy as np
-import pandas as pd
 from utils.db_utils import Neo4jConnection
 from utils.select_amenity import SelectAmenities
+from utils.csr_graph import CSRGraph
+from utils.path_utils import PathUtils, DEFAULT_METRICS
+from utils.contraction_hierarchy import ContractionHierarchy
+from utils.landmarks import LandmarkIndex
+from utils.route_cache import RouteCache
+from utils.gds_routing import ProjectionManager, GDSRouting
+from utils.matrix_io import CSVPathWriter, BinaryPathWriter, MatrixCheckpoint, save_weight_matrix
 import logging
 logging.getLogger("neo4j").setLevel(logging.ERROR)
 
 
 class Routing:
 
+    def __init__(self, graph=None, cache=None):
+        self.graph = graph
+        self.cache = cache
+
     def evaluate_path_metrics(self,conn,pairs):
         with conn.driver.session() as session:
-            query = """unwind %s as pairs
+            query = """unwind $pairs as pairs
                 match (n:FootNode{id: pairs[0]})-[r:ROUTE]->(m:FootNode{id:pairs[1]})
                 with min(r.cost) as min_cost, pairs
                 match (n:FootNode{id: pairs[0]})-[r:ROUTE]->(m:FootNode{id:pairs[1]})
                 where r.cost = min_cost
-                return sum(r.cost) as cost,avg(r.danger) as danger,sum(r.distance) as distance"""%(pairs)
-            result = session.run(query)
-        return result.values()
+                return sum(r.cost) as cost,avg(r.danger) as danger,sum(r.distance) as distance"""
+            result = session.run(query, pairs=[[str(p) for p in pair] for pair in pairs])
+            return result.values()
+
+    def evaluate_paths_metrics(self, conn, paths, metrics=DEFAULT_METRICS):
+        """sums of the metrics along many paths, on the in-memory graph when it has all of them loaded"""
+        if isinstance(self.graph, CSRGraph) and all(m in self.graph.weights for m in metrics):
+            return self.graph.path_metrics(paths, metrics)
+        return PathUtils().evaluate_paths_metrics(conn, paths, metrics)
 
     def routing(self, conn, pointA, pointB, weight):
         """evaluate the best route between the source and the target"""
@@ -45,19 +62,153 @@ class Routing:
               weight as totalCost, 
               [n in nodes(path) | n.id] as shortestHopNodeIds """%(str(pointA), str(pointB), str(weight))
             result = session.run(query)
-            return result.values()[0]
+            values = result.values()
+            # no row when the target cannot be reached, as local_routing
+            return values[0] if values else [[], float('inf'), []]
 
+    def local_routing(self, pointA, pointB, weight):
+        """evaluate the best route between the source and the target on the in-memory graph"""
+        result = self.graph.shortest_path(pointA, pointB, weight)
+        if result is None:
+            return [[], float('inf'), []]
+        cost, nodes, edges = result
+        return [edges, cost, nodes]
 
     def find_best_path(self, conn, pointA, pointB, weight):
-        result = self.routing(conn, pointA, pointB, weight)
+        if self.cache is not None:
+            dic = self.cache.get(pointA, pointB, weight)
+            if dic is not None:
+                return dic
+
+        if self.graph is None:
+            result = self.routing(conn, pointA, pointB, weight)
+        else:
+            result = self.local_routing(pointA, pointB, weight)
         
         dic = {}
         dic["path"] = result[0]
         dic["cost"] = result[1]
         dic["nodes"] = result[2]
 
+        if self.cache is not None:
+            self.cache.put(pointA, pointB, weight, dic)
         return dic
 
+    def find_best_paths_from(self, conn, pointA, points, weight):
+        """evaluate the best routes from the source to all the targets with a single search"""
+        if self.graph is None:
+            return [self.find_best_path(conn, pointA, pointB, weight) for pointB in points]
+
+        paths = {}
+        if self.cache is not None:
+            for pointB in points:
+                dic = self.cache.get(pointA, pointB, weight)
+                if dic is not None:
+                    paths[pointB] = dic
+        missing = [pointB for pointB in points if pointB not in paths]
+        if missing:
+            results = self.graph.shortest_paths_from(pointA, missing, weight)
+            for pointB in missing:
+                result = results[pointB]
+                if result is None:
+                    paths[pointB] = {"path": [], "cost": float('inf'), "nodes": []}
+                else:
+                    paths[pointB] = {"path": result[2], "cost": result[0], "nodes": result[1]}
+                if self.cache is not None:
+                    self.cache.put(pointA, pointB, weight, paths[pointB])
+        return [paths[pointB] for pointB in points]
+
+
+def compute_paths(routing, conn, source, targets, weight, matrix_mode):
+    """compute the paths from the source to each target"""
+    if matrix_mode == 'one_to_many':
+        best_paths = routing.find_best_paths_from(conn, source, targets, weight)
+    else:
+        best_paths = [routing.find_best_path(conn, source, target, weight) for target in targets]
+
+    paths = []
+    for target, best_path in zip(targets, best_paths):
+        paths.append({
+            'start_point': source,
+            'end_point': target,
+            'cost': best_path['cost'],
+            'path_nodes': best_path['nodes']
+        })
+    return paths
+
+
+def compute_row(routing, conn, points, index_row, weight, matrix_mode):
+    """compute the paths from points[index_row] to the points of the next columns"""
+    return compute_paths(routing, conn, points[index_row], points[index_row + 1:], weight, matrix_mode)
+
+
+worker = {}
+
+
+def init_worker(conn_params, graph, cache, points, weight, matrix_mode):
+    """open the worker's own driver (engine neo4j) or keep its copy of the engine (in-memory graph,
+    contraction hierarchy, or gds engine which opens its own driver)"""
+    if graph is None:
+        worker['conn'] = Neo4jConnection(*conn_params)
+        worker['conn'].open_connection()
+    else:
+        worker['conn'] = None
+    worker['routing'] = Routing(graph, cache)
+    worker['points'] = points
+    worker['weight'] = weight
+    worker['matrix_mode'] = matrix_mode
+
+
+def compute_worker_row(index_row):
+    return index_row, compute_row(worker['routing'], worker['conn'], worker['points'], index_row,
+                                  worker['weight'], worker['matrix_mode'])
+
+
+def compute_worker_paths(task):
+    source, targets = task
+    return source, compute_paths(worker['routing'], worker['conn'], source, targets,
+                                 worker['weight'], worker['matrix_mode'])
+
+
+def compute_rows(routing, conn, points, weight, matrix_mode, rows, workers=1, conn_params=None):
+    """yield (index_row, paths) for the given rows, in order, using a pool of processes if workers > 1"""
+    if workers <= 1:
+        for index_row in rows:
+            yield index_row, compute_row(routing, conn, points, index_row, weight, matrix_mode)
+        return
+    with Pool(workers, initializer=init_worker,
+              initargs=(conn_params, routing.graph, routing.cache, points, weight, matrix_mode)) as pool:
+        for result in pool.imap(compute_worker_row, rows):
+            yield result
+
+
+def compute_routes(routing, conn, tasks, weight, matrix_mode, workers=1, conn_params=None):
+    """yield (source, paths) for the (source, targets) tasks, in order, using a pool of processes if workers > 1"""
+    if workers <= 1:
+        for source, targets in tasks:
+            yield source, compute_paths(routing, conn, source, targets, weight, matrix_mode)
+        return
+    with Pool(workers, initializer=init_worker,
+              initargs=(conn_params, routing.graph, routing.cache, None, weight, matrix_mode)) as pool:
+        for result in pool.imap(compute_worker_paths, tasks):
+            yield result
+
+
+def load_graph(conn, weight, snapshot_filename=None):
+    """load the FootNode/ROUTE graph in memory, reusing the snapshot file if it has the weight and
+    was taken from the current version of the graph (see Neo4jConnection.get_graph_version)"""
+    version = conn.get_graph_version()
+    if snapshot_filename and os.path.exists(snapshot_filename):
+        graph = CSRGraph.load(snapshot_filename)
+        if weight in graph.weights and graph.version == version:
+            return graph
+    graph = CSRGraph.from_neo4j(conn, [weight])
+    graph.version = version
+    if snapshot_filename:
+        graph.save(snapshot_filename)
+    return graph
+
+
 def add_options():
     """Parameters needed to run the script"""
     parser = argparse.ArgumentParser(description='Find the best path between each pair of points and calculate the weight matrix.')
@@ -94,6 +245,38 @@ def add_options():
     parser.add_argument('--path_filename', '-pfn', dest='path_filename', type=str,
                         help="""Insert the name of the file to write the paths (as sequence of FootNode nodes).""",
                         required=False, default="paths.csv")
+    parser.add_argument('--engine', '-e', dest='engine', type=str, choices=['neo4j', 'gds', 'local', 'ch'],
+                        help="""Insert where to compute the paths: 'neo4j' runs apoc.algo.aStar for each pair, 'gds' runs the GDS shortest path procedures on a projection of the graph kept warm across runs, 'local' loads the graph once in memory and runs A* in the script, 'ch' queries a contraction hierarchy built with graph/build_contraction_hierarchy.py.""",
+                        required=False, default="neo4j")
+    parser.add_argument('--graph_snapshot', '-gs', dest='graph_snapshot', type=str,
+                        help="""Insert the name of the .npz file to store and reuse the in-memory graph (only with engine = local).""",
+                        required=False)
+    parser.add_argument('--landmarks_filename', '-lm', dest='landmarks_filename', type=str,
+                        help="""Insert the name of the file with the landmark index built with graph/build_landmarks.py, to speed up A* (only with engine = local).""",
+                        required=False)
+    parser.add_argument('--ch_filename', '-ch', dest='ch_filename', type=str,
+                        help="""Insert the name of the file with the contraction hierarchy of the weight (only with engine = ch).""",
+                        required=False)
+    parser.add_argument('--matrix_mode', '-mm', dest='matrix_mode', type=str, choices=['pairwise', 'one_to_many'],
+                        help="""Insert how to fill the weight matrix: 'pairwise' runs a search for each pair of points, 'one_to_many' runs a single search from each point to all the points of its row (only with engine = gds, local or ch).""",
+                        required=False, default="pairwise")
+    parser.add_argument('--workers', '-wk', dest='workers', type=int,
+                        help="""Insert the number of processes computing the rows of the matrix in parallel, each one with its own Neo4j session or its own copy of the in-memory graph.""",
+                        required=False, default=1)
+    parser.add_argument('--checkpoint_filename', '-cfn', dest='checkpoint_filename', type=str,
+                        help="""Insert the name of the checkpoint file recording the completed rows (default: the matrix file name followed by .checkpoint).""",
+                        required=False)
+    parser.add_argument('--resume', '-r', dest='resume', action='store_true',
+                        help="""Resume an interrupted job from its checkpoint file, skipping the rows already computed.""")
+    parser.add_argument('--output_format', '-of', dest='output_format', type=str, choices=['csv', 'binary'],
+                        help="""Insert the format of the output files: 'csv' or 'binary' (the matrix as a .npy file and the paths in a directory of memory-mappable arrays).""",
+                        required=False, default="csv")
+    parser.add_argument('--cache_filename', '-cf', dest='cache_filename', type=str,
+                        help="""Insert the name of the file of the route cache shared by the routing runs, it is emptied automatically when the graph changes.""",
+                        required=False)
+    parser.add_argument('--cache_size', '-cs', dest='cache_size', type=int,
+                        help="""Insert the maximum size of the route cache in MB, the least recently used routes are removed above it.""",
+                        required=False, default=1024)
     return parser
 
 
@@ -101,10 +284,33 @@ def add_options():
 def main(args=None):
     argParser = add_options()
     options = argParser.parse_args(args=args)
+    if(options.matrix_mode == 'one_to_many' and options.engine == 'neo4j'):
+        argParser.error("--matrix_mode one_to_many requires --engine gds, local or ch")
+    if(options.engine == 'ch' and options.ch_filename is None):
+        argParser.error("--engine ch requires --ch_filename")
     neo4jconn = Neo4jConnection(options.neo4jURL, options.neo4juser, options.neo4jpwd)
     neo4jconn.open_connection()
     
-    routing = Routing()
+    if(options.engine == 'local'):
+        graph = load_graph(neo4jconn, options.weight, options.graph_snapshot)
+        if(options.landmarks_filename):
+            landmarks = LandmarkIndex.load(options.landmarks_filename)
+            landmarks.check_version(graph.version)
+            graph.set_landmarks(landmarks)
+        routing = Routing(graph)
+    elif(options.engine == 'gds'):
+        projection = ProjectionManager(neo4jconn).get_projection('FootNode', [options.weight])
+        routing = Routing(GDSRouting(neo4jconn, projection))
+    elif(options.engine == 'ch'):
+        ch = ContractionHierarchy.load(options.ch_filename)
+        ch.check_weight(options.weight)
+        ch.check_version(neo4jconn.get_graph_version())
+        routing = Routing(ch)
+    else:
+        routing = Routing()
+    if(options.cache_filename):
+        routing.cache = RouteCache(options.cache_filename, neo4jconn.get_graph_version(),
+                                   options.cache_size * 1024 * 1024)
     
     if(options.points == 'all' or options.points == 'bbox'):
         sa = SelectAmenities()
@@ -121,6 +327,9 @@ def main(args=None):
     
     matrixFilename = options.matrix_filename
     pathFilename = options.path_filename
+    if(options.output_format == 'binary'):
+        matrixFilename = os.path.splitext(matrixFilename)[0] + '.npy'
+        pathFilename = os.path.splitext(pathFilename)[0]
     
     weight = options.weight
     
@@ -128,44 +337,44 @@ def main(args=None):
     n_points = len(points)
     print("Number of points for routing: " + str(n_points))
     
-    # with neo4jconn.driver.session() as session:
-    #     query = """call gds.graph.project(
-    #     'subgraph_routing', 
-    #     ['FootNode'], 
-    #     ['ROUTE'], 
-    #     {nodeProperties: ['lat', 'lon'], relationshipProperties: ['%s']})"""%(str(weight))
-    #     session.run(query)
-    
     weight_matrix = np.zeros([n_points, n_points])
-    paths = []
     
-    for index_row in tqdm(range(n_points), desc="Rows"):
-        for index_column in range(index_row + 1, n_points):
-            if weight_matrix[index_row][index_column] == 0:
-                best_path = routing.find_best_path(neo4jconn, points[index_row], points[index_column], weight)
-                cost = best_path['cost']
-                nodes = best_path['nodes']
-                
-                weight_matrix[index_row][index_column] = cost
-                weight_matrix[index_column][index_row] = cost
-                
-                paths.append({
-                    'start_point': points[index_row],
-                    'end_point': points[index_column],
-                    'cost': cost,
-                    'path_nodes': ' '.join(nodes)
-                })
-            
+    checkpoint = MatrixCheckpoint(options.checkpoint_filename or matrixFilename + '.checkpoint')
+    done_rows, state = checkpoint.load(points, weight) if options.resume else ({}, None)
+    if(state is not None):
+        print("Resuming from checkpoint: " + str(len(done_rows)) + " rows already computed")
+    if(options.output_format == 'binary'):
+        path_writer = BinaryPathWriter(pathFilename, points, state)
+    else:
+        path_writer = CSVPathWriter(pathFilename, state)
+    if(state is None):
+        checkpoint.start(points, weight, path_writer.state())
+    else:
+        checkpoint.resume(done_rows, state)
     
-    weight_matrix_df = pd.DataFrame(weight_matrix, index=points, columns=points)
-    weight_matrix_df.to_csv(matrixFilename)
+    for index_row, costs in done_rows.items():
+        for index_column, cost in enumerate(costs, start=index_row + 1):
+            weight_matrix[index_row][index_column] = cost
+            weight_matrix[index_column][index_row] = cost
     
-    path_df = pd.DataFrame(paths)
-    path_df.to_csv(pathFilename, index=False)
-
-    # with neo4jconn.driver.session() as session:
-    #     query = """CALL gds.graph.drop('subgraph_routing')"""
-    #     session.run(query)
+    todo_rows = [index_row for index_row in range(n_points) if index_row not in done_rows]
+    rows = compute_rows(routing, neo4jconn, points, weight, options.matrix_mode, todo_rows,
+                        workers=options.workers,
+                        conn_params=(options.neo4jURL, options.neo4juser, options.neo4jpwd))
+    for index_row, row_paths in tqdm(rows, total=len(todo_rows), desc="Rows"):
+        costs = [path['cost'] for path in row_paths]
+        for index_column, cost in enumerate(costs, start=index_row + 1):
+            weight_matrix[index_row][index_column] = cost
+            weight_matrix[index_column][index_row] = cost
+        path_writer.write_row(row_paths)
+        checkpoint.add_row(index_row, costs, path_writer.state())
+    
+    path_writer.close()
+    
+    save_weight_matrix(weight_matrix, points, matrixFilename)
+    checkpoint.remove()
+    if(routing.cache is not None):
+        routing.cache.close()
 
     neo4jconn.close_connection()
     
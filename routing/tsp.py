@@ -2,7 +2,7 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from ast import operator
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, READ_ACCESS
 import overpy
 import json
 import argparse
@@ -12,26 +12,29 @@ import random
 from utils.db_utils import Neo4jConnection
 from utils.path_utils import PathUtils
 from utils.select_amenity import SelectAmenities
+from utils.gds_routing import ProjectionManager
+from utils.tsp_solver import solve_tsp, EXACT_LIMIT
+from utils.matrix_io import load_weight_matrix, load_path_store
+from utils.route_cache import RouteCache
+from utils.gds_routing import GDSRouting
+from routing import Routing, compute_routes
+from tqdm import tqdm
+import csv
 import numpy as np
 
 
 class TSP:
 
 
-    def find_best_path(self,conn,points,weight):
-        """evaluate the best route to visit several point"""
-        with conn.driver.session() as session:
+    def pairwise_routes(self,conn,points,weight,projection=None):
+        """shortest routes between all the pairs of points, with apoc.algo.aStar or on a gds projection.
+        Returns a dict (id, id) -> (cost, node ids), with one direction for each pair.
+        The routes are only kept in memory: the query does not write anything in the graph,
+        so it runs in a read session and many tours can be solved at the same time."""
+        with conn.driver.session(default_access_mode=READ_ACCESS) as session:
 
-            query = """
-            WITH %s as selection
-            MATCH (c:FootNode) 
-            WHERE c.id in selection 
-            WITH collect(c) as footnodes 
-            UNWIND footnodes as c1 
-                WITH 
-                  c1, 
-                  [c in footnodes where c.id > c1.id] as c2s, 
-                  footnodes 
+            if projection is None:
+                shortest_routes = """
                 UNWIND c2s as c2 
                     CALL apoc.algo.aStar(
                       c1, 
@@ -45,62 +48,161 @@ class TSP:
                       weight as totalCost, 
                       [n in nodes(path) | n.id] as shortestHopNodeIds, 
                       [r in relationships(path) | id(r)] as shortestHopRelIds, 
-                      footnodes 
-                    MERGE (c1) -[r:SHORTEST_ROUTE_TO]- (c2) 
-                    SET r.cost = totalCost 
-                    SET r.shortestHopNodeIds = shortestHopNodeIds
-                    SET r.shortestHopRelIds = shortestHopRelIds 
+                      footnodes"""%(weight)
+            else:
+                # one single-source search on the projection for each point
+                shortest_routes = """
+                WHERE size(c2s) > 0
+                WITH c1, [c in c2s | id(c)] as c2ids, footnodes
+                    CALL gds.allShortestPaths.dijkstra.stream(
+                      '%s',
+                      {sourceNode: id(c1), relationshipWeightProperty: '%s'})
+                    YIELD targetNode, totalCost, nodeIds
+                    WITH c1, targetNode, totalCost, nodeIds, footnodes
+                    WHERE targetNode in c2ids
                     WITH 
                       c1, 
-                      c2, 
-                      (size(footnodes)-1) as level, 
-                      footnodes 
-                    CALL apoc.path.expandConfig(
-                      c1, 
-                      { relationshipFilter: 'SHORTEST_ROUTE_TO', 
-                        minLevel: level, 
-                        maxLevel: level, 
-                        whitelistNodes: footnodes, 
-                        terminatorNodes: [c2], 
-                        uniqueness: 'NODE_PATH' } ) 
-                    YIELD path
-                    WITH nodes(path) as orderedFootnodes, 
-                    [node in nodes(path) | node.id] as orderedIds,
-                    reduce(cost = 0, x in relationships(path) | cost + x.cost) as totalCost, 
-                    [r in relationships(path) | r.shortestHopNodeIds] as shortestRouteNodeIds
-                    MATCH (:FootNode {id: orderedIds[0]})-[rel:SHORTEST_ROUTE_TO]-(:FootNode {id: reverse(orderedIds)[0]})
-                    WITH orderedFootnodes+orderedFootnodes[0] as orderedFootnodes, orderedIds+orderedIds[0] as orderedIds, totalCost+rel.cost as totalCost, shortestRouteNodeIds as shortestRouteNodeIds
-                    ORDER BY totalCost LIMIT 1
-                    UNWIND range(0, size(orderedFootnodes)) as index 
-                        UNWIND shortestRouteNodeIds[index] as shortestHopNodeId 
-                            WITH orderedFootnodes, 
-                            totalCost,
-                            index,
-                            CASE 
-                                WHEN toString(shortestRouteNodeIds[index][0]) = toString(orderedIds[index])
-                                THEN tail(collect(shortestHopNodeId)) 
-                                ELSE tail(reverse(collect(shortestHopNodeId))) 
-                            END as orderedHopNodeIds 
-                            ORDER BY index 
-                            UNWIND orderedHopNodeIds as orderedHopNodeId 
-                                MATCH (c:FootNode) where c.id = orderedHopNodeId 
-                                with 
-                                  [c in orderedFootnodes | c.id] as orderedFootnodesIds, 
-                                  totalCost,
-                                  orderedFootnodes[0].id as first,
-                                  orderedFootnodes[size(orderedFootnodes)-2].id as last,
-                                  [orderedFootnodes[0].id] + collect(c.id) as footnodeRouteIds
-                            MATCH (:FootNode {id: toString(first)})-[r:SHORTEST_ROUTE_TO]-(:FootNode {id: toString(last)})
-                            with orderedFootnodesIds, totalCost, footnodeRouteIds, r,
-                            CASE 
-                                WHEN toString(r.shortestHopNodeIds[0]) = toString(last)
-                                THEN tail(REDUCE(s = [], item IN r.shortestHopNodeIds | s + item))
-                                ELSE tail(reverse(REDUCE(s = [], item IN r.shortestHopNodeIds | s + item)))
-                            END as lastpath
-                            return orderedFootnodesIds, totalCost, footnodeRouteIds+lastpath as totalPath"""%(points.tolist(),weight)
+                      gds.util.asNode(targetNode) as c2, 
+                      totalCost, 
+                      [n in gds.util.asNodes(nodeIds) | n.id] as shortestHopNodeIds, 
+                      [] as shortestHopRelIds, 
+                      footnodes"""%(projection, weight)
+
+            query = """
+            WITH %s as selection
+            MATCH (c:FootNode) 
+            WHERE c.id in selection 
+            WITH collect(c) as footnodes 
+            UNWIND footnodes as c1 
+                WITH 
+                  c1, 
+                  [c in footnodes where c.id > c1.id] as c2s, 
+                  footnodes 
+                %s
+                    RETURN c1.id, c2.id, totalCost, shortestHopNodeIds"""%(list(points), shortest_routes)
 
             result = session.run(query)
-            return result.values()[0]
+            return {(str(record[0]), str(record[1])): (record[2], [str(n) for n in record[3]])
+                    for record in result}
+
+    def cost_matrix(self,points,routes):
+        """symmetric matrix of the route costs between the points, inf for the pairs without a route"""
+        matrix = np.full((len(points), len(points)), np.inf)
+        np.fill_diagonal(matrix, 0)
+        for i, a in enumerate(points):
+            for j, b in enumerate(points):
+                route = routes.get((a, b)) or routes.get((b, a))
+                if route is not None:
+                    matrix[i, j] = route[0]
+        return matrix
+
+    def tour_path(self,points,tour,get_path):
+        """ordered points of the tour (back to the first one) and the sequence of FootNode nodes.
+        get_path(a, b) returns the node ids of the route from a to b, empty if there is none."""
+        ordered = [points[i] for i in tour] + [points[tour[0]]]
+        path = [ordered[0]]
+        for a, b in zip(ordered, ordered[1:]):
+            if a == b:
+                continue
+            nodes = get_path(a, b)
+            if not nodes:
+                return ordered, []
+            path += nodes[1:]
+        return ordered, path
+
+    def best_tour(self,points,matrix,get_path,solver='auto',time_limit=None):
+        """solve the tour on the cost matrix of the points and join the routes of its legs"""
+        tour, cost, gap = solve_tsp(matrix, solver, time_limit=time_limit)
+        ordered, path = self.tour_path(points, tour, get_path)
+        return [ordered, cost, path, gap]
+
+    def find_best_path(self,conn,points,weight,projection=None,solver='auto',time_limit=None):
+        """evaluate the best route to visit several point: the routes between all the pairs of
+        points are computed once, then the order of the points is chosen on their cost matrix.
+        Returns the ordered points, the cost, the path and the optimality gap of the tour."""
+        points = list(dict.fromkeys(str(p) for p in points))
+        routes = self.pairwise_routes(conn, points, weight, projection)
+        return self.best_tour_on_routes(points, routes, solver, time_limit)
+
+    def best_tour_on_routes(self,points,routes,solver='auto',time_limit=None):
+        """best tour with the routes of a dict (id, id) -> (cost, node ids), in either direction"""
+
+        def get_path(a, b):
+            if (a, b) in routes:
+                return routes[(a, b)][1]
+            if (b, a) in routes:
+                return routes[(b, a)][1][::-1]
+            return []
+
+        return self.best_tour(points, self.cost_matrix(points, routes), get_path, solver, time_limit)
+
+    def batch_routes(self,routing,conn,itineraries,weight,workers=1,conn_params=None):
+        """routes between all the pairs of points of the same itinerary, each pair computed once
+        also when it appears in several itineraries, with a single-source search for each point"""
+        targets = {}
+        for points in itineraries:
+            points = sorted(set(points))
+            for i, a in enumerate(points):
+                targets.setdefault(a, set()).update(points[i + 1:])
+        tasks = [(a, sorted(b)) for a, b in sorted(targets.items()) if b]
+        routes = {}
+        for source, paths in tqdm(compute_routes(routing, conn, tasks, weight, 'one_to_many', workers, conn_params),
+                                  total=len(tasks), desc="Points"):
+            for path in paths:
+                routes[(source, path['end_point'])] = (path['cost'], path['path_nodes'])
+        return routes
+
+    def find_best_path_from_matrix(self,points,matrix_points,weight_matrix,path_store,solver='auto',time_limit=None):
+        """same as find_best_path, with the routes of a weight matrix and a path store written by
+        routing.py: the points must be a subset of the points of the matrix"""
+        points = list(dict.fromkeys(str(p) for p in points))
+        index = {str(point): i for i, point in enumerate(matrix_points)}
+        missing = [p for p in points if p not in index]
+        if missing:
+            raise ValueError("Points not in the weight matrix: %s" % ' '.join(missing))
+        positions = [index[p] for p in points]
+        matrix = np.array(weight_matrix[np.ix_(positions, positions)], dtype=np.float64)
+        np.fill_diagonal(matrix, 0)
+
+        def get_path(a, b):
+            return path_store.get_path(a, b)[1]
+
+        return self.best_tour(points, matrix, get_path, solver, time_limit)
+
+def solve_itineraries(tsp, conn, options, matrix_points=None, weight_matrix=None, path_store=None):
+    """solve every tour of the itineraries file and write one line for each of them"""
+    with open(options.itineraries_filename) as f:
+        itineraries = [list(dict.fromkeys(line.split())) for line in f if line.strip()]
+    print("Number of itineraries: " + str(len(itineraries)))
+
+    if matrix_points is None:
+        if(options.engine == 'gds'):
+            projection = ProjectionManager(conn).get_projection('FootNode', [options.weight])
+            routing = Routing(GDSRouting(conn, projection))
+        else:
+            routing = Routing()
+        if(options.cache_filename):
+            routing.cache = RouteCache(options.cache_filename, conn.get_graph_version())
+        routes = tsp.batch_routes(routing, conn, itineraries, options.weight, options.workers,
+                                  (options.neo4jURL, options.neo4juser, options.neo4jpwd))
+        if(routing.cache is not None):
+            routing.cache.close()
+
+    with open(options.batch_filename, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['itinerary', 'feasible', 'ordered_points', 'cost', 'gap', 'path_nodes'])
+        for index, points in enumerate(tqdm(itineraries, desc="Tours")):
+            if matrix_points is None:
+                best_path = tsp.best_tour_on_routes(points, routes, options.solver, options.time_limit)
+            else:
+                best_path = tsp.find_best_path_from_matrix(points, matrix_points, weight_matrix, path_store,
+                                                           options.solver, options.time_limit)
+            ordered, cost, path, gap = best_path
+            # some pair of points has no route: there is no tour
+            if not path or not np.isfinite(cost):
+                writer.writerow([index, 'no', ' '.join(points), '', '', ''])
+                continue
+            writer.writerow([index, 'yes', ' '.join(ordered), cost, '' if gap is None else gap, ' '.join(path)])
 
 
 def add_options():
@@ -129,50 +231,99 @@ def add_options():
     parser.add_argument('--mapName', '-mn', dest='map_filename', type=str,
                        help="""Insert the name of the file containing the map with the computed path.""",
                        required=False, default='tsp_map.html')
+    parser.add_argument('--engine', '-e', dest='engine', type=str, choices=['neo4j', 'gds'],
+                       help="""Insert where to compute the shortest routes between the points: 'neo4j' runs apoc.algo.aStar for each pair, 'gds' runs a single-source search for each point on a projection of the graph kept warm across runs.""",
+                       required=False, default='neo4j')
+    parser.add_argument('--solver', '-s', dest='solver', type=str, choices=['auto', 'exact', 'heuristic', 'branch_and_bound'],
+                       help="""Insert how to choose the order of the points: 'exact' (Held-Karp dynamic programming, up to about 18 points), 'heuristic' (nearest neighbour tours improved with 2-opt and Or-opt moves), 'branch_and_bound' (optimal tour, or the best one found within the time limit) or 'auto' (exact up to %d points, above that branch and bound if a time limit is given, heuristic otherwise).""" % EXACT_LIMIT,
+                       required=False, default='auto')
+    parser.add_argument('--time_limit', '--time-limit', '-tl', dest='time_limit', type=float,
+                       help="""Insert the maximum number of seconds spent by the branch and bound solver, which then returns the best tour found and its optimality gap.""",
+                       required=False)
+    parser.add_argument('--input_matrix', '-im', dest='input_matrix', type=str,
+                       help="""Insert the name of a weight matrix written by routing.py (csv or .npy): the tour is computed on its costs, without routing in the database. The points must be a subset of the points of the matrix, and the weight is the one used to compute it.""",
+                       required=False)
+    parser.add_argument('--input_paths', '-ip', dest='input_paths', type=str,
+                       help="""Insert the name of the paths written by routing.py together with the input matrix (csv file or binary path store directory).""",
+                       required=False)
+    parser.add_argument('--itineraries_filename', '-it', dest='itineraries_filename', type=str,
+                       help="""Insert the name of a file with many tours to compute, one per line as space-separated OSM identifiers of the FootNode nodes to visit. The routes between the points are computed once for all the tours.""",
+                       required=False)
+    parser.add_argument('--batch_filename', '-bfn', dest='batch_filename', type=str,
+                       help="""Insert the name of the csv file with the result of each tour of the itineraries file.""",
+                       required=False, default='tsp_batch.csv')
+    parser.add_argument('--workers', '-wk', dest='workers', type=int,
+                       help="""Insert the number of processes computing the routes of the itineraries in parallel.""",
+                       required=False, default=1)
+    parser.add_argument('--cache_filename', '-cf', dest='cache_filename', type=str,
+                       help="""Insert the name of the file of the route cache shared with routing.py, used for the routes of the itineraries.""",
+                       required=False)
     return parser
 
 
 def main(args=None):
     argParser = add_options()
     options = argParser.parse_args(args=args)
+    if (options.input_matrix is None) != (options.input_paths is None):
+        argParser.error("--input_matrix and --input_paths must be given together")
     neo4jconn = Neo4jConnection(options.neo4jURL, options.neo4juser, options.neo4jpwd)
     neo4jconn.open_connection()
 
     tsp = TSP()
     
+    if options.input_matrix is not None:
+        matrix_points, weight_matrix = load_weight_matrix(options.input_matrix)
+        path_store = load_path_store(options.input_paths)
+    
+    if options.itineraries_filename is not None:
+        if options.input_matrix is not None:
+            solve_itineraries(tsp, neo4jconn, options, matrix_points, weight_matrix, path_store)
+        else:
+            solve_itineraries(tsp, neo4jconn, options)
+        neo4jconn.close_connection()
+        return 0
+    
     if(options.points == 'random'):
-        sa = SelectAmenities()
-        amenities = sa.select_amenity(neo4jconn)
-        amenities = sa.amenity_to_df(amenities)
-        points = np.random.choice(amenities['rj_osm_id'].values, options.num_points)
+        if options.input_matrix is not None:
+            points = np.random.choice(matrix_points, min(options.num_points, len(matrix_points)), replace=False)
+        else:
+            sa = SelectAmenities()
+            amenities = sa.select_amenity(neo4jconn)
+            amenities = sa.amenity_to_df(amenities)
+            points = np.random.choice(amenities['rj_osm_id'].values, options.num_points)
     else:
         points = options.points.split()
         points = [str(p) for p in points]
-        if(len(point)>6):
-            print("Please select a lower number of points (max 6)")
-            return 0
         
  
-    # with neo4jconn.driver.session() as session:
-    #     query = """call gds.graph.project(
-    #     'subgraph_tsp', 
-    #     ['FootNode'], 
-    #     ['ROUTE'], 
-    #     {nodeProperties: ['lat', 'lon'], relationshipProperties: ['%s']})"""%(str(options.weight))
-    #     session.run(query)
-    
-    best_path = tsp.find_best_path(neo4jconn, points, options.weight)
+    if options.input_matrix is not None:
+        best_path = tsp.find_best_path_from_matrix(points, matrix_points, weight_matrix, path_store,
+                                                   options.solver, options.time_limit)
+    else:
+        projection = None
+        if(options.engine == 'gds'):
+            projection = ProjectionManager(neo4jconn).get_projection('FootNode', [options.weight])
+        
+        best_path = tsp.find_best_path(neo4jconn, points, options.weight, projection, options.solver, options.time_limit)
     
     ordered_footnodes = best_path[0]
     cost = best_path[1]
     path = best_path[2]
+    gap = best_path[3]
     
     print("Ordered FootNode to visit:" + str(ordered_footnodes))
     print("Total cost:" + str(cost))
+    if gap is not None:
+        print("Optimality gap: %.2f%%" % (100 * gap))
     # print("Path:" + str(path))
     
+    if len(path) == 0:
+        print('No path')
+        neo4jconn.close_connection()
+        return 0
+    
     with open(options.path_filename, "w") as f:
-        f.write(path)
+        f.write(' '.join(path))
     
     path_utils = PathUtils()
     
@@ -191,10 +342,6 @@ def main(args=None):
     print("Green area weight: " + str(green_area_weight))
 
 
-    # with neo4jconn.driver.session() as session:
-    #     query = """CALL gds.graph.drop('subgraph_tsp')"""
-    #     session.run(query)
-
     neo4jconn.close_connection()
     
     
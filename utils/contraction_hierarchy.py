@@ -0,0 +1,320 @@
+import math
+import heapq
+import numpy as np
+
+
+class ContractionHierarchy:
+    """Contraction hierarchy of a CSRGraph for a single weight.
+
+    Nodes are contracted one at a time (lowest priority first) adding shortcut edges
+    that preserve the shortest path costs among the remaining nodes. Every edge,
+    original or shortcut, is stored once: in the up arrays of its source when the
+    target has a higher rank, in the down arrays of its target (pointing back to the
+    source) otherwise. Queries only climb the hierarchy from both ends, so they settle
+    a few hundred nodes even on city-scale graphs."""
+
+    def __init__(self, weight, node_ids, rank, up, down, version=None):
+        self.weight = weight
+        # GraphVersion stamp of the graph the hierarchy was built from
+        self.version = version
+        self.node_ids = np.asarray(node_ids, dtype=str)
+        self.rank = np.asarray(rank, dtype=np.int32)
+        # up and down: (indptr, targets, costs, middles, edge_ids), middle = -1 for original edges
+        self.up = tuple(np.asarray(a) for a in up)
+        self.down = tuple(np.asarray(a) for a in down)
+        self.index = {node_id: i for i, node_id in enumerate(self.node_ids.tolist())}
+        self._lists = None
+        self._edges = None
+
+    @classmethod
+    def build(cls, graph, weight, witness_limit=500, priority_limit=50):
+        """contract all the nodes of the graph, witness searches settle at most witness_limit nodes"""
+        n = graph.n_nodes
+        indptr, indices, costs = graph.adjacency(weight)
+        out_edges = [dict() for _ in range(n)]
+        in_edges = [dict() for _ in range(n)]
+        for u in range(n):
+            for k in range(indptr[u], indptr[u + 1]):
+                w = indices[k]
+                c = costs[k]
+                if w == u or not c < math.inf:
+                    continue
+                if w not in out_edges[u] or c < out_edges[u][w][0]:
+                    out_edges[u][w] = (c, -1, int(graph.edge_ids[k]))
+                    in_edges[w][u] = out_edges[u][w]
+
+        def shortcuts(v, limit):
+            found = []
+            if not in_edges[v] or not out_edges[v]:
+                return found
+            max_out = max(c for c, _, _ in out_edges[v].values())
+            for u, (cu, _, _) in in_edges[v].items():
+                targets = [w for w in out_edges[v] if w != u]
+                if not targets:
+                    continue
+                dist = witness_search(out_edges, u, v, cu + max_out, limit)
+                for w in targets:
+                    c = cu + out_edges[v][w][0]
+                    if dist.get(w, math.inf) > c:
+                        found.append((u, w, c))
+            return found
+
+        deleted_neighbors = [0] * n
+
+        def priority(v):
+            return (len(shortcuts(v, priority_limit)) - len(in_edges[v]) - len(out_edges[v])
+                    + deleted_neighbors[v])
+
+        heap = [(priority(v), v) for v in range(n)]
+        heapq.heapify(heap)
+        rank = [0] * n
+        up = [None] * n
+        down = [None] * n
+        level = 0
+        while heap:
+            _, v = heapq.heappop(heap)
+            # lazy update: contract v only if it is still the best candidate
+            p = priority(v)
+            if heap and p > heap[0][0]:
+                heapq.heappush(heap, (p, v))
+                continue
+
+            for u, w, c in shortcuts(v, witness_limit):
+                if w not in out_edges[u] or c < out_edges[u][w][0]:
+                    out_edges[u][w] = (c, v, -1)
+                    in_edges[w][u] = out_edges[u][w]
+
+            rank[v] = level
+            level += 1
+            up[v] = out_edges[v]
+            down[v] = in_edges[v]
+            for u in in_edges[v]:
+                del out_edges[u][v]
+                deleted_neighbors[u] += 1
+            for w in out_edges[v]:
+                del in_edges[w][v]
+                deleted_neighbors[w] += 1
+
+        return cls(weight, graph.node_ids, rank, cls._to_csr(up), cls._to_csr(down), graph.version)
+
+    @staticmethod
+    def _to_csr(adjacency):
+        indptr = np.zeros(len(adjacency) + 1, dtype=np.int64)
+        np.cumsum([len(edges) for edges in adjacency], out=indptr[1:])
+        records = [(w,) + edge for edges in adjacency for w, edge in edges.items()]
+        if not records:
+            records = np.zeros((0, 4))
+        records = np.asarray(records, dtype=np.float64).reshape(-1, 4)
+        return (indptr, records[:, 0].astype(np.int32), records[:, 1],
+                records[:, 2].astype(np.int32), records[:, 3].astype(np.int64))
+
+    def save(self, filename):
+        arrays = {}
+        for name, csr in (('up', self.up), ('down', self.down)):
+            for field, values in zip(('indptr', 'targets', 'costs', 'middles', 'edge_ids'), csr):
+                arrays[name + '_' + field] = values
+        with open(filename, 'wb') as f:
+            np.savez(f, weight=np.array(self.weight), version=np.array(self.version or ''),
+                     node_ids=self.node_ids, rank=self.rank, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            fields = ('indptr', 'targets', 'costs', 'middles', 'edge_ids')
+            version = (str(data['version']) or None) if 'version' in data.files else None
+            return cls(str(data['weight']), data['node_ids'], data['rank'],
+                       [data['up_' + field] for field in fields],
+                       [data['down_' + field] for field in fields], version)
+
+    def node_position(self, node_id):
+        try:
+            return self.index[str(node_id)]
+        except KeyError:
+            raise ValueError("Node %s is not in the graph" % node_id)
+
+    def check_weight(self, weight):
+        if weight != self.weight:
+            raise ValueError("The contraction hierarchy was built for %s, not for %s" % (self.weight, weight))
+
+    def check_version(self, version):
+        """the shortcuts of a hierarchy built on another version of the graph give wrong routes"""
+        if version != self.version:
+            raise ValueError("The contraction hierarchy was built for version %s of the graph, the current one is %s: "
+                             "build it again with graph/build_contraction_hierarchy.py" % (self.version, version))
+
+    def lists(self):
+        if self._lists is None:
+            self._lists = (tuple(a.tolist() for a in self.up[:4]), tuple(a.tolist() for a in self.down[:4]))
+        return self._lists
+
+    def upward_search(self, source, csr, max_cost=math.inf):
+        """Dijkstra on the edges towards higher ranks only, returns distances and parent edge positions"""
+        indptr, targets, costs = csr[:3]
+        dist = {source: 0.0}
+        parent = {source: -1}
+        heap = [(0.0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            if d > max_cost:
+                break
+            for k in range(indptr[u], indptr[u + 1]):
+                v = targets[k]
+                nd = d + costs[k]
+                if nd < dist.get(v, math.inf):
+                    dist[v] = nd
+                    parent[v] = k
+                    heapq.heappush(heap, (nd, v))
+        return dist, parent
+
+    def query(self, s, t):
+        """bidirectional search between node positions, returns (cost, meeting node, parents)"""
+        (up_indptr, up_targets, up_costs, _), (down_indptr, down_targets, down_costs, _) = self.lists()
+        dist = ({s: 0.0}, {t: 0.0})
+        parent = ({s: -1}, {t: -1})
+        heaps = ([(0.0, s)], [(0.0, t)])
+        csrs = ((up_indptr, up_targets, up_costs), (down_indptr, down_targets, down_costs))
+        best = 0.0 if s == t else math.inf
+        meeting = s if s == t else -1
+        side = 0
+        while (heaps[0] and heaps[0][0][0] < best) or (heaps[1] and heaps[1][0][0] < best):
+            if not (heaps[side] and heaps[side][0][0] < best):
+                side = 1 - side
+            d, u = heapq.heappop(heaps[side])
+            if d <= dist[side][u]:
+                other = dist[1 - side].get(u)
+                if other is not None and d + other < best:
+                    best = d + other
+                    meeting = u
+                indptr, targets, costs = csrs[side]
+                for k in range(indptr[u], indptr[u + 1]):
+                    v = targets[k]
+                    nd = d + costs[k]
+                    if nd < dist[side].get(v, math.inf):
+                        dist[side][v] = nd
+                        parent[side][v] = k
+                        heapq.heappush(heaps[side], (nd, v))
+            side = 1 - side
+        return best, meeting, parent
+
+    def many_to_many(self, sources, targets):
+        """cost matrix between node positions with the bucket algorithm, plus the meeting nodes"""
+        (up_indptr, up_targets, up_costs, _), down = self.lists()
+        buckets = {}
+        backward = []
+        for j, t in enumerate(targets):
+            dist, parent = self.upward_search(t, down[:3])
+            backward.append((dist, parent))
+            for v, d in dist.items():
+                buckets.setdefault(v, []).append((j, d))
+
+        costs = np.full((len(sources), len(targets)), np.inf)
+        meetings = np.full((len(sources), len(targets)), -1, dtype=np.int64)
+        forward = []
+        for i, s in enumerate(sources):
+            dist, parent = self.upward_search(s, (up_indptr, up_targets, up_costs))
+            forward.append((dist, parent))
+            row = costs[i]
+            meeting = meetings[i]
+            for v, d in dist.items():
+                for j, db in buckets.get(v, ()):
+                    if d + db < row[j]:
+                        row[j] = d + db
+                        meeting[j] = v
+        return costs, meetings, forward, backward
+
+    def unpack(self, meeting, forward_parent, backward_parent):
+        """node ids and edge ids of the path through the meeting node, with all shortcuts expanded"""
+        up_lists, down_lists = self.lists()
+        up_sources = self._sources('up')
+        down_owners = self._sources('down')
+        hops = []
+        node = meeting
+        while forward_parent[node] != -1:
+            k = forward_parent[node]
+            node = up_sources[k]
+            hops.append((node, up_lists[1][k], up_lists[3][k], int(self.up[4][k])))
+        hops.reverse()
+        node = meeting
+        while backward_parent[node] != -1:
+            k = backward_parent[node]
+            hops.append((node, down_owners[k], down_lists[3][k], int(self.down[4][k])))
+            node = down_owners[k]
+
+        nodes = [meeting] if not hops else [hops[0][0]]
+        edges = []
+        for hop in hops:
+            stack = [hop]
+            while stack:
+                u, w, middle, edge_id = stack.pop()
+                if middle == -1:
+                    nodes.append(w)
+                    edges.append(edge_id)
+                else:
+                    stack.append((middle, w) + self._edge(middle, w))
+                    stack.append((u, middle) + self._edge(u, middle))
+        return [str(self.node_ids[i]) for i in nodes], edges
+
+    def _sources(self, name):
+        """node owning each position of the up or down arrays"""
+        attribute = '_' + name + '_sources'
+        if getattr(self, attribute, None) is None:
+            indptr = getattr(self, name)[0]
+            setattr(self, attribute, np.repeat(np.arange(len(indptr) - 1), np.diff(indptr)).tolist())
+        return getattr(self, attribute)
+
+    def _edge(self, u, w):
+        """middle node and edge id of the edge from u to w"""
+        if self._edges is None:
+            self._edges = {}
+            for (_, targets, _, middles, edge_ids), owners, forward in ((self.up, self._sources('up'), True),
+                                                                        (self.down, self._sources('down'), False)):
+                for owner, target, middle, edge_id in zip(owners, targets.tolist(), middles.tolist(), edge_ids.tolist()):
+                    key = (owner, target) if forward else (target, owner)
+                    self._edges[key] = (middle, edge_id)
+        return self._edges[(u, w)]
+
+    def shortest_path(self, source, target, weight):
+        """same interface as CSRGraph.shortest_path"""
+        self.check_weight(weight)
+        cost, meeting, parent = self.query(self.node_position(source), self.node_position(target))
+        if meeting == -1:
+            return None
+        return (cost,) + tuple(self.unpack(meeting, parent[0], parent[1]))
+
+    def shortest_paths_from(self, source, targets, weight):
+        """same interface as CSRGraph.shortest_paths_from"""
+        self.check_weight(weight)
+        positions = [self.node_position(t) for t in targets]
+        costs, meetings, forward, backward = self.many_to_many([self.node_position(source)], positions)
+        paths = {}
+        for j, target in enumerate(targets):
+            if meetings[0][j] == -1:
+                paths[target] = None
+            else:
+                nodes, edges = self.unpack(int(meetings[0][j]), forward[0][1], backward[j][1])
+                paths[target] = (float(costs[0][j]), nodes, edges)
+        return paths
+
+
+def witness_search(out_edges, source, ignore, max_cost, limit):
+    """bounded Dijkstra from source that avoids the node being contracted"""
+    dist = {source: 0.0}
+    heap = [(0.0, source)]
+    settled = 0
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        if d > max_cost or settled >= limit:
+            break
+        settled += 1
+        for v, (c, _, _) in out_edges[u].items():
+            if v == ignore:
+                continue
+            nd = d + c
+            if nd < dist.get(v, math.inf):
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return dist
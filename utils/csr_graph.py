@@ -0,0 +1,323 @@
+import re
+import math
+import heapq
+import numpy as np
+
+
+EARTH_RADIUS = 6371000.0
+PROPERTY_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+# a property, or an element of a list property such as pm25_per_meter[1] (one value per time interval)
+WEIGHT_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\[[0-9]+\])?$')
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """great-circle distance in meters, works on scalars and numpy arrays"""
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def check_property_name(name, pattern=PROPERTY_PATTERN):
+    if not pattern.match(name):
+        raise ValueError("Invalid property name: %s" % name)
+    return name
+
+
+class CSRGraph:
+    """Array-backed snapshot of the routing graph in compressed sparse row layout.
+
+    Node i is node_ids[i], its outgoing edges are the positions indptr[i]:indptr[i+1]
+    of indices (target node), edge_ids (id of the ROUTE relationship) and of every
+    float column in weights (one column per routing weight)."""
+
+    def __init__(self, node_ids, lat, lon, indptr, indices, edge_ids, weights):
+        self.node_ids = np.asarray(node_ids, dtype=str)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.edge_ids = np.asarray(edge_ids, dtype=np.int64)
+        self.weights = {name: np.asarray(values, dtype=np.float64) for name, values in weights.items()}
+        self.index = {node_id: i for i, node_id in enumerate(self.node_ids.tolist())}
+        self._adjacency_cache = {}
+        self._scale_cache = {}
+        self._sources = None
+        self.landmarks = None
+        # GraphVersion stamp of the graph the arrays were loaded from, if known
+        self.version = None
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    @classmethod
+    def from_edges(cls, node_ids, lat, lon, sources, targets, edge_ids, weights, directed=False):
+        """build the CSR arrays from an edge list given as node positions.
+        With directed=False every edge can be traversed in both directions, as the
+        'ROUTE' relationship filter of apoc.algo.aStar does."""
+        n_nodes = len(node_ids)
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        edge_ids = np.asarray(edge_ids, dtype=np.int64)
+        weights = {name: np.asarray(values, dtype=np.float64) for name, values in weights.items()}
+        if not directed:
+            sources, targets = np.concatenate([sources, targets]), np.concatenate([targets, sources])
+            edge_ids = np.concatenate([edge_ids, edge_ids])
+            weights = {name: np.concatenate([values, values]) for name, values in weights.items()}
+
+        order = np.argsort(sources, kind='stable')
+        indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=n_nodes), out=indptr[1:])
+        return cls(node_ids, lat, lon, indptr, targets[order], edge_ids[order],
+                   {name: values[order] for name, values in weights.items()})
+
+    @classmethod
+    def from_neo4j(cls, conn, weights, node_label='FootNode', directed=False):
+        """load the node_label/ROUTE subgraph with the given weight properties"""
+        node_label = check_property_name(node_label)
+        weights = [check_property_name(w, WEIGHT_PATTERN) for w in weights]
+
+        node_ids, lat, lon = [], [], []
+        sources, targets, edge_ids = [], [], []
+        columns = [[] for _ in weights]
+        with conn.driver.session() as session:
+            result = session.run("""
+                MATCH (n:%s) RETURN n.id as id, n.lat as lat, n.lon as lon"""%(node_label))
+            for record in result:
+                node_ids.append(str(record[0]))
+                lat.append(record[1])
+                lon.append(record[2])
+            index = {node_id: i for i, node_id in enumerate(node_ids)}
+
+            query = """
+                MATCH (n:%s)-[r:ROUTE]->(m:%s)
+                RETURN n.id as source, m.id as target, id(r) as edge_id%s"""%(
+                    node_label, node_label, ''.join(', r.%s' % w for w in weights))
+            result = session.run(query)
+            for record in result:
+                sources.append(index[str(record[0])])
+                targets.append(index[str(record[1])])
+                edge_ids.append(record[2])
+                for column, value in zip(columns, record.values()[3:]):
+                    column.append(math.inf if value is None else value)
+
+        return cls.from_edges(node_ids, lat, lon, sources, targets, edge_ids,
+                              dict(zip(weights, columns)), directed=directed)
+
+    def save(self, filename):
+        arrays = {'weight_' + name: values for name, values in self.weights.items()}
+        with open(filename, 'wb') as f:
+            np.savez(f, node_ids=self.node_ids, lat=self.lat, lon=self.lon, indptr=self.indptr,
+                     indices=self.indices, edge_ids=self.edge_ids, version=np.array(self.version or ''),
+                     weight_names=np.array(list(self.weights), dtype=str), **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            weights = {name: data['weight_' + name] for name in data['weight_names'].tolist()}
+            graph = cls(data['node_ids'], data['lat'], data['lon'], data['indptr'],
+                        data['indices'], data['edge_ids'], weights)
+            graph.version = (str(data['version']) or None) if 'version' in data.files else None
+            return graph
+
+    def node_position(self, node_id):
+        try:
+            return self.index[str(node_id)]
+        except KeyError:
+            raise ValueError("Node %s is not in the graph" % node_id)
+
+    def edge_sources(self):
+        return np.repeat(np.arange(self.n_nodes, dtype=np.int32), np.diff(self.indptr))
+
+    def adjacency(self, weight):
+        """plain python lists of the CSR arrays, much faster to index in the search loops"""
+        if weight not in self.weights:
+            raise ValueError("Weight %s has not been loaded in the graph" % weight)
+        if weight not in self._adjacency_cache:
+            self._adjacency_cache[weight] = (self.indptr.tolist(), self.indices.tolist(),
+                                             self.weights[weight].tolist())
+        return self._adjacency_cache[weight]
+
+    def heuristic_scale(self, weight):
+        """largest k such that k * haversine(u, v) never overestimates the cost from u to v"""
+        if weight not in self._scale_cache:
+            costs = self.weights[weight]
+            sources = self.edge_sources()
+            straight = haversine(self.lat[sources], self.lon[sources],
+                                 self.lat[self.indices], self.lon[self.indices])
+            mask = (straight > 0) & np.isfinite(costs)
+            scale = float(np.min(costs[mask] / straight[mask])) if mask.any() else 0.0
+            # shrink a little so rounding never makes the heuristic inadmissible
+            self._scale_cache[weight] = max(scale * (1 - 1e-9), 0.0)
+        return self._scale_cache[weight]
+
+    def set_landmarks(self, landmarks):
+        """use the lower bounds of a LandmarkIndex built on this graph in the A* searches"""
+        if not np.array_equal(landmarks.node_ids, self.node_ids):
+            if set(landmarks.node_ids.tolist()) != set(self.index):
+                raise ValueError("The landmark index was built on a different graph")
+            landmarks = landmarks.reordered(self.node_ids)
+        self.landmarks = landmarks
+
+    def heuristic(self, t, weight):
+        """lower bounds of the cost from every node to the node in position t, None if there are none"""
+        bounds = []
+        scale = self.heuristic_scale(weight)
+        if scale > 0:
+            bounds.append(np.nan_to_num(scale * haversine(self.lat, self.lon, self.lat[t], self.lon[t])))
+        if self.landmarks is not None and weight in self.landmarks.weights:
+            bounds.append(self.landmarks.lower_bounds(t, weight))
+        if not bounds:
+            return None
+        return np.maximum.reduce(bounds).tolist()
+
+    def reversed(self):
+        """graph with the direction of every edge inverted"""
+        return CSRGraph.from_edges(self.node_ids, self.lat, self.lon, self.indices, self.edge_sources(),
+                                   self.edge_ids, self.weights, directed=True)
+
+    def distances_from(self, s, weight):
+        """costs of the shortest paths from the node in position s to all the nodes (inf if unreachable)"""
+        indptr, indices, costs = self.adjacency(weight)
+        dist = [math.inf] * self.n_nodes
+        dist[s] = 0.0
+        heap = [(0.0, s)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                nd = d + costs[k]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return np.array(dist)
+
+    def shortest_path(self, source, target, weight):
+        """A* search between two node ids.
+        Returns (cost, node ids, edge ids), or None if the target cannot be reached."""
+        s = self.node_position(source)
+        t = self.node_position(target)
+        indptr, indices, costs = self.adjacency(weight)
+
+        h = self.heuristic(t, weight)
+
+        dist = {s: 0.0}
+        parent = {s: -1}
+        heap = [(0.0, 0.0, s)]
+        while heap:
+            _, d, u = heapq.heappop(heap)
+            if u == t:
+                break
+            if d > dist[u]:
+                continue
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                nd = d + costs[k]
+                if nd < dist.get(v, math.inf):
+                    dist[v] = nd
+                    parent[v] = k
+                    heapq.heappush(heap, (nd + h[v] if h else nd, nd, v))
+        else:
+            return None
+
+        return (dist[t],) + self._unwind(parent, t)
+
+    def _unwind(self, parent, node):
+        """node ids and edge ids of the path ending in node, from the parent edge positions"""
+        if self._sources is None:
+            self._sources = self.edge_sources().tolist()
+        sources = self._sources
+        nodes = [node]
+        edges = []
+        k = parent[node]
+        while k != -1:
+            edges.append(k)
+            node = sources[k]
+            nodes.append(node)
+            k = parent[node]
+        nodes.reverse()
+        edges.reverse()
+        return [str(self.node_ids[i]) for i in nodes], [int(self.edge_ids[k]) for k in edges]
+
+    def shortest_paths_from(self, source, targets, weight):
+        """single-source Dijkstra from source that stops once every target is settled.
+        Returns a dict target id -> (cost, node ids, edge ids), None for unreachable targets."""
+        s = self.node_position(source)
+        remaining = {self.node_position(t) for t in targets}
+        indptr, indices, costs = self.adjacency(weight)
+
+        dist = {s: 0.0}
+        parent = {s: -1}
+        settled = set()
+        heap = [(0.0, s)]
+        while heap and remaining:
+            d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+            remaining.discard(u)
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                nd = d + costs[k]
+                if nd < dist.get(v, math.inf):
+                    dist[v] = nd
+                    parent[v] = k
+                    heapq.heappush(heap, (nd, v))
+
+        paths = {}
+        for target in targets:
+            t = self.node_position(target)
+            if t in settled:
+                paths[target] = (dist[t],) + self._unwind(parent, t)
+            else:
+                paths[target] = None
+        return paths
+
+    def edge_lookup(self):
+        """sorted source * n_nodes + target keys of all the edges and their positions in the CSR arrays.
+        Between two nodes linked by several edges the shortest one (by distance, if loaded) comes first."""
+        if getattr(self, '_edge_lookup', None) is None:
+            keys = self.edge_sources().astype(np.int64) * self.n_nodes + self.indices
+            if 'distance' in self.weights:
+                order = np.lexsort((self.weights['distance'], keys))
+            else:
+                order = np.argsort(keys, kind='stable')
+            self._edge_lookup = (keys[order], order)
+        return self._edge_lookup
+
+    def path_edges(self, paths):
+        """edges of many paths given as lists of node ids: (positions of the edges in the CSR arrays,
+        index of the path of each edge, True for the paths with two consecutive nodes not linked)"""
+        lengths = np.array([len(path) for path in paths], dtype=np.int64)
+        nodes = np.array([self.node_position(node) for path in paths for node in path], dtype=np.int64)
+        path_index = np.repeat(np.arange(len(paths)), lengths)
+        # positions of the first node of every pair of consecutive nodes of the same path
+        hops = np.flatnonzero(path_index[1:] == path_index[:-1])
+        hop_path = path_index[hops]
+        keys = nodes[hops] * self.n_nodes + nodes[hops + 1]
+
+        sorted_keys, order = self.edge_lookup()
+        found = np.searchsorted(sorted_keys, keys)
+        valid = found < len(sorted_keys)
+        valid[valid] = sorted_keys[found[valid]] == keys[valid]
+        missing = np.zeros(len(paths), dtype=bool)
+        missing[hop_path[~valid]] = True
+        return order[found[valid]], hop_path[valid], missing
+
+    def path_metrics(self, paths, metrics):
+        """sums of the metrics (loaded weights) along many paths given as lists of node ids.
+        Returns one dict metric -> sum for each path, None for the paths with a missing edge."""
+        for metric in metrics:
+            if metric not in self.weights:
+                raise ValueError("Weight %s has not been loaded in the graph" % metric)
+        positions, edge_path, missing = self.path_edges(paths)
+        sums = {metric: np.bincount(edge_path, weights=self.weights[metric][positions], minlength=len(paths))
+                for metric in metrics}
+        return [None if missing[i] else {metric: float(sums[metric][i]) for metric in metrics}
+                for i in range(len(paths))]
@@ -41,6 +41,23 @@ class Neo4jConnection:
             """
             session.run(query)
 
+    def get_graph_version(self):
+        """version stamp of the graph, it changes every time the graph or its edge weights are modified"""
+        with self.driver.session() as session:
+            result = session.run("""
+            MATCH (v:GraphVersion) RETURN v.version""")
+            record = result.single()
+            return record[0] if record else None
+
+    def update_graph_version(self, reason):
+        """write a new version stamp, to be called by the scripts that build or enrich the graph"""
+        with self.driver.session() as session:
+            result = session.run("""
+            MERGE (v:GraphVersion)
+            SET v.version = randomUUID(), v.updated_at = datetime(), v.reason = $reason
+            RETURN v.version""", reason=reason)
+            return result.single()[0]
+
     def get_coordinates(self,nodes):
         with self.driver.session() as session:
             query = f"""
@@ -49,14 +66,15 @@ class Neo4jConnection:
             result = session.run(query)
             return result.values()
 
-    def get_edges_endpoints(self):
+    def get_edges_endpoints(self, missing_property=None):
+        """ids and coordinates of the ends of the edges, only the edges without missing_property if given"""
         with self.driver.session() as session:
             query = """
-            MATCH (s:RouteNode)-[r:ROUTE]->(d:RouteNode)
+            MATCH (s:RouteNode)-[r:ROUTE]->(d:RouteNode)%s
             RETURN s.id AS source, d.id AS destination, 
             s.lon AS source_lon, s.lat AS source_lat, 
             d.lon AS destination_lon, d.lat AS destination_lat
-            """
+            """%(" WHERE r.%s IS NULL" % missing_property if missing_property else "")
             result = session.run(query)
             return result.values()
 
@@ -0,0 +1,122 @@
+import os
+from utils.db_utils import Neo4jConnection
+from utils.csr_graph import check_property_name
+
+
+class ProjectionManager:
+    """Named GDS projections of the routing graph, kept in the graph catalog across runs.
+
+    There is one projection for each (node label, weights) pair. Its name ends with
+    the graph version (see Neo4jConnection.get_graph_version), so it is created the
+    first time it is needed, reused by the following runs and rebuilt (dropping the
+    stale one) only after the graph or its weights change."""
+
+    prefix = 'grafmove'
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def base_name(self, node_label, weights):
+        return '%s_%s_%s' % (self.prefix, node_label, '_'.join(sorted(weights)))
+
+    def is_version_of(self, name, base):
+        """name is a projection of base for some graph version: the version suffix has no '_',
+        while the weight names may have it, so base must match exactly without the suffix"""
+        return name.rsplit('_', 1)[0] == base
+
+    def get_projection(self, node_label, weights):
+        node_label = check_property_name(node_label)
+        weights = [check_property_name(w) for w in weights]
+        version = self.conn.get_graph_version() or 'none'
+        base = self.base_name(node_label, weights)
+        name = base + '_' + version.replace('-', '')[:12]
+
+        with self.conn.driver.session() as session:
+            result = session.run("""CALL gds.graph.list() YIELD graphName RETURN graphName""")
+            names = [record[0] for record in result]
+            for other in names:
+                if self.is_version_of(other, base) and other != name:
+                    self.conn.drop_projection(other)
+            if name not in names:
+                try:
+                    # UNDIRECTED as the 'ROUTE' filter of apoc.algo.aStar, which follows both directions
+                    session.run("""
+                        CALL gds.graph.project($name, $label,
+                            {ROUTE: {orientation: 'UNDIRECTED', properties: $weights}},
+                            {nodeProperties: ['lat', 'lon']})
+                        YIELD graphName RETURN graphName""",
+                                name=name, label=node_label, weights=weights).consume()
+                except Exception:
+                    # another run may have created it in the meantime
+                    result = session.run("""CALL gds.graph.exists($name) YIELD exists RETURN exists""", name=name)
+                    if not result.single()[0]:
+                        raise
+        return name
+
+    def release(self, node_label, weights):
+        """drop all the projections of the (node label, weights) pair"""
+        base = self.base_name(node_label, weights)
+        with self.conn.driver.session() as session:
+            result = session.run("""CALL gds.graph.list() YIELD graphName RETURN graphName""")
+            names = [record[0] for record in result]
+        for name in names:
+            if self.is_version_of(name, base):
+                self.conn.drop_projection(name)
+
+
+class GDSRouting:
+    """Shortest paths computed by GDS on a managed projection.
+
+    It has the same interface as CSRGraph (shortest_path and shortest_paths_from), so
+    it can be used as the engine of Routing. The driver is opened again in every
+    process, so the object can be handed to the worker processes."""
+
+    def __init__(self, conn, projection):
+        self.conn_params = (conn.uri, conn.user, conn.password)
+        self.projection = projection
+        self._conn = conn
+        self._pid = os.getpid()
+
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = Neo4jConnection(*self.conn_params)
+            self._conn.open_connection()
+            self._pid = os.getpid()
+        return self._conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        return state
+
+    def shortest_path(self, source, target, weight):
+        with self.conn().driver.session() as session:
+            result = session.run("""
+                MATCH (a:FootNode {id: $source}), (b:FootNode {id: $target})
+                CALL gds.shortestPath.dijkstra.stream($projection, {
+                    sourceNode: id(a), targetNode: id(b), relationshipWeightProperty: $weight})
+                YIELD totalCost, nodeIds
+                RETURN totalCost, [n in gds.util.asNodes(nodeIds) | n.id]""",
+                                 source=str(source), target=str(target), projection=self.projection, weight=weight)
+            record = result.single()
+        if record is None:
+            return None
+        # the relationships of a projection are not the ROUTE relationships of the graph
+        return record[0], record[1], []
+
+    def shortest_paths_from(self, source, targets, weight):
+        """all the paths from the source with a single gds.allShortestPaths.dijkstra call"""
+        with self.conn().driver.session() as session:
+            result = session.run("""
+                MATCH (a:FootNode {id: $source})
+                MATCH (b:FootNode) WHERE b.id IN $targets
+                WITH a, collect(id(b)) as targetIds
+                CALL gds.allShortestPaths.dijkstra.stream($projection, {
+                    sourceNode: id(a), relationshipWeightProperty: $weight})
+                YIELD targetNode, totalCost, nodeIds
+                WITH targetNode, totalCost, nodeIds WHERE targetNode IN targetIds
+                RETURN gds.util.asNode(targetNode).id, totalCost, [n in gds.util.asNodes(nodeIds) | n.id]""",
+                                 source=str(source), targets=[str(t) for t in targets],
+                                 projection=self.projection, weight=weight)
+            found = {record[0]: (record[1], record[2], []) for record in result}
+        return {target: found.get(str(target)) for target in targets}
@@ -0,0 +1,277 @@
+import os
+import csv
+import math
+import numpy as np
+import pandas as pd
+
+
+# radius used by point.distance for WGS-84 points, so that the distances match the ones set in Cypher
+NEO4J_EARTH_RADIUS = 6378140.0
+# radius used by osmnx for the bounding boxes and the length of the edges
+OSMNX_EARTH_RADIUS = 6371009.0
+
+
+def point_distance(lat1, lon1, lat2, lon2):
+    """great-circle distance in meters as computed by Neo4j point.distance, on numpy arrays"""
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * NEO4J_EARTH_RADIUS * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def graph_tables(G):
+    """typed node and edge tables of an osmnx graph, with the properties of the RouteNode/ROUTE graph.
+
+    nodes: one row per node with id (the OSM id as a string, as stored by apoc.import.graphml),
+    x, y, lat, lon, latitude, longitude (floats), the WKT geometry and the osmnx attributes.
+    edges: one row per edge with source and target (node ids), distance (float, meters) and the
+    osmnx attributes. Missing attributes are NaN/None."""
+    node_ids = [str(node) for node in G.nodes()]
+    nodes = pd.DataFrame.from_records([data for _, data in G.nodes(data=True)], index=range(len(node_ids)))
+    nodes = nodes.drop(columns=[c for c in ('geometry', 'id') if c in nodes.columns])
+    nodes.insert(0, 'id', node_ids)
+    nodes['x'] = nodes['x'].astype(np.float64)
+    nodes['y'] = nodes['y'].astype(np.float64)
+    nodes['lat'] = nodes['latitude'] = nodes['y']
+    nodes['lon'] = nodes['longitude'] = nodes['x']
+    nodes['geometry'] = ['POINT(%r %r)' % (lon, lat) for lon, lat in zip(nodes['lon'].tolist(), nodes['lat'].tolist())]
+
+    edge_list = list(G.edges(data=True))
+    edges = pd.DataFrame.from_records([data for _, _, data in edge_list], index=range(len(edge_list)))
+    # shapely geometries of simplified graphs are not stored
+    edges = edges.drop(columns=[c for c in ('geometry', 'source', 'target', 'distance') if c in edges.columns])
+    edges.insert(0, 'source', [str(u) for u, _, _ in edge_list])
+    edges.insert(1, 'target', [str(v) for _, v, _ in edge_list])
+    position = pd.Series(np.arange(len(nodes)), index=nodes['id'])
+    source = position[edges['source']].to_numpy()
+    target = position[edges['target']].to_numpy()
+    lat, lon = nodes['lat'].to_numpy(), nodes['lon'].to_numpy()
+    edges['distance'] = point_distance(lat[source], lon[source], lat[target], lon[target])
+    return nodes, edges
+
+
+# rules of the road classes, from 1 (dedicated to pedestrians or cyclists) to 5: the first rule whose
+# conditions are all true gives the class. A condition is a list of values of an edge property, or a
+# range (low, high] of its integer value (None for no bound).
+FOOT_CLASS_RULES = [
+    (1, {'highway': ['pedestrian', 'footway', 'steps']}),
+    (1, {'highway': ['living_street'], 'foot': ['yes'], 'segregated': ['yes']}),
+    (1, {'highway': ['path'], 'foot': ['yes'], 'segregated': ['yes']}),
+    (1, {'highway': ['track'], 'foot': ['yes'], 'segregated': ['yes']}),
+    (1, {'foot': ['designated']}),
+    (1, {'footway': ['sidewalk']}),
+    (1, {'sidewalk': ['left', 'right', 'both', 'yes', 'lane', 'separate']}),
+    (2, {'foot': ['yes']}),
+    (2, {'highway': ['footway'], 'bicycle': ['yes']}),
+    (2, {'bicycle': ['designated'], 'segregated': ['no']}),
+    (2, {'highway': ['residential', 'unclassified', 'path', 'track', 'service', 'living_street']}),
+    (2, {'highway': ['living_street'], 'foot': ['yes'], 'segregated': ['no']}),
+    (2, {'highway': ['path'], 'foot': ['yes'], 'segregated': ['no']}),
+    (2, {'highway': ['track'], 'foot': ['yes'], 'segregated': ['no']}),
+    (2, {'maxspeed': (None, 30)}),
+    (3, {'maxspeed': (30, 50)}),
+    (4, {'maxspeed': (50, None)}),
+]
+BIKE_CLASS_RULES = [
+    (1, {'highway': ['cycleway']}),
+    (1, {'cycleway': ['track']}),
+    (1, {'cycleway_right': ['track']}),
+    (1, {'cycleway_left': ['track']}),
+    (1, {'cycleway_both': ['track']}),
+    (1, {'bicycle': ['use_sidepath']}),
+    (1, {'bicycle': ['designated'], 'segregated': ['yes']}),
+    (2, {'cycleway': ['lane']}),
+    (2, {'cycleway_left': ['lane']}),
+    (2, {'cycleway_right': ['lane']}),
+    (2, {'cycleway_both': ['lane']}),
+    (2, {'cycleway': ['share_busway']}),
+    (2, {'cycleway_left': ['share_busway']}),
+    (2, {'cycleway_right': ['share_busway']}),
+    (2, {'highway': ['footway'], 'bicycle': ['yes']}),
+    (2, {'highway': ['residential', 'unclassified', 'path', 'track', 'service', 'living_street']}),
+    (2, {'bicycle': ['designated'], 'segregated': ['no']}),
+    (2, {'maxspeed': (None, 30)}),
+    (3, {'maxspeed': (30, 50)}),
+    (4, {'maxspeed': (50, None)}),
+]
+DEFAULT_CLASS = 5
+
+# roads left out of the connected components of the graph: the pedestrians and the cyclists are
+# allowed only on the nodes of the largest component of the other roads
+COMPONENT_EXCLUDED_HIGHWAYS = ["motorway", "motorway_link", "motorway_junction",
+                               "trunk", "trunk_link", "primary", "primary_link", "secondary", "secondary_link",
+                               "busway", "bus_guideway", "bus_stop",
+                               "escape", "raceway", "corridor", "services", "emergency_bay", "proposed", "construction"]
+
+
+def class_case(rules, variable='r'):
+    """Cypher CASE expression of the class of the relationship variable, from a rule table"""
+    lines = ['case']
+    for value, conditions in rules:
+        terms = []
+        for name, condition in conditions.items():
+            if isinstance(condition, tuple):
+                low, high = condition
+                if low is not None:
+                    terms.append('toInteger(%s.%s)>%s' % (variable, name, low))
+                if high is not None:
+                    terms.append('toInteger(%s.%s)<=%s' % (variable, name, high))
+            elif len(condition) == 1:
+                terms.append("%s.%s='%s'" % (variable, name, condition[0]))
+            else:
+                terms.append('%s.%s in [%s]' % (variable, name, ', '.join("'%s'" % c for c in condition)))
+        lines.append('    when %s then %d' % (' and '.join(terms), value))
+    lines.append('    else %d' % DEFAULT_CLASS)
+    lines.append('end')
+    return '\n'.join(lines)
+
+
+def road_classes(edges, rules):
+    """class of every edge of the table from a rule table, as the Cypher CASE of class_case"""
+    classes = np.full(len(edges), DEFAULT_CLASS, dtype=np.int64)
+    assigned = np.zeros(len(edges), dtype=bool)
+    missing = pd.Series([None] * len(edges), index=edges.index, dtype=object)
+    columns = {}
+    numbers = {}
+    for value, conditions in rules:
+        mask = ~assigned
+        for name, condition in conditions.items():
+            if name not in columns:
+                # the values as stored in Neo4j (lists become strings)
+                columns[name] = edges[name].astype(object).map(property_value) if name in edges.columns else missing
+            column = columns[name]
+            if isinstance(condition, tuple):
+                if name not in numbers:
+                    # toInteger of a string such as '30' or '30.5', null for '30 mph'
+                    numbers[name] = np.trunc(pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64))
+                low, high = condition
+                if low is not None:
+                    mask &= numbers[name] > low
+                if high is not None:
+                    mask &= numbers[name] <= high
+            else:
+                mask &= column.isin(condition).to_numpy()
+        classes[mask] = value
+        assigned |= mask
+    return classes
+
+
+def add_edge_attributes(nodes, edges):
+    """properties of the edges that depend on their end nodes or tags, computed for all the edges at
+    once: the WKT geometry (as set_edge_geometry) and foot_class and bike_class (as classify_roads)"""
+    position = pd.Series(np.arange(len(nodes)), index=nodes['id'])
+    source = position[edges['source']].to_numpy()
+    target = position[edges['target']].to_numpy()
+    lat, lon = nodes['lat'].to_numpy(), nodes['lon'].to_numpy()
+    edges['geometry'] = ['LINESTRING(%r %r, %r %r)' % row for row in
+                         zip(lon[source].tolist(), lat[source].tolist(), lon[target].tolist(), lat[target].tolist())]
+    edges['foot_class'] = road_classes(edges, FOOT_CLASS_RULES)
+    edges['bike_class'] = road_classes(edges, BIKE_CLASS_RULES)
+    return edges
+
+
+def stitch_tables(tables):
+    """node and edge tables of overlapping tiles merged into one: the nodes found in several tiles are
+    kept once by OSM id (with their largest street_count, the tile where they are not on the border),
+    the edges by end nodes and OSM way id"""
+    nodes = pd.concat([tile_nodes for tile_nodes, _ in tables], ignore_index=True)
+    if 'street_count' in nodes.columns:
+        nodes = nodes.sort_values('street_count', ascending=False, kind='stable')
+    nodes = nodes.drop_duplicates('id').sort_index().reset_index(drop=True)
+
+    edges = pd.concat([tile_edges for _, tile_edges in tables], ignore_index=True)
+    keys = edges['source'] + ' ' + edges['target']
+    if 'osmid' in edges.columns:
+        keys = keys + ' ' + edges['osmid'].astype(object).map(lambda value: str(property_value(value)))
+    edges = edges[~keys.duplicated().to_numpy()].reset_index(drop=True)
+    return nodes, edges
+
+
+def property_value(value):
+    """value of a table cell as a Neo4j property: None for missing values, lists and other
+    objects (e.g. the list of OSM ids of a simplified edge) as strings"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def property_rows(table, start=0, stop=None):
+    """rows start:stop of a table as dicts of properties, without the missing values"""
+    part = table.iloc[start:stop]
+    columns = [(name, [property_value(value) for value in part[name].tolist()]) for name in part.columns]
+    return [{name: values[i] for name, values in columns if values[i] is not None} for i in range(len(part))]
+
+
+def write_tables(conn, nodes, edges, batch_size=10000):
+    """create the RouteNode nodes and the ROUTE relationships of the tables with parameterised
+    UNWIND batches of batch_size rows (the index on the node id is created first)"""
+    with conn.driver.session() as session:
+        session.run("""
+            CREATE INDEX osmnode_id_index IF NOT EXISTS FOR (n:RouteNode) ON (n.id)""").consume()
+        for start in range(0, len(nodes), batch_size):
+            session.run("""
+                UNWIND $rows AS row
+                CREATE (n:RouteNode)
+                SET n = row, n.location = point({latitude: row.lat, longitude: row.lon, srid: 4326})""",
+                        rows=property_rows(nodes, start, start + batch_size)).consume()
+        for start in range(0, len(edges), batch_size):
+            rows = property_rows(edges, start, start + batch_size)
+            session.run("""
+                UNWIND $rows AS row
+                MATCH (a:RouteNode {id: row.source})
+                MATCH (b:RouteNode {id: row.target})
+                CREATE (a)-[r:ROUTE]->(b)
+                SET r = row.properties""",
+                        rows=[{'source': row.pop('source'), 'target': row.pop('target'), 'properties': row}
+                              for row in rows]).consume()
+
+
+def csv_type(series):
+    """neo4j-admin import type of a table column"""
+    if pd.api.types.is_bool_dtype(series):
+        return 'boolean'
+    if pd.api.types.is_integer_dtype(series):
+        return 'long'
+    if pd.api.types.is_float_dtype(series):
+        return 'double'
+    return 'string'
+
+
+def csv_value(value):
+    value = property_value(value)
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+
+def write_admin_csv(nodes, edges, dirname):
+    """node and relationship files for an offline bulk load with neo4j-admin import.
+    Returns the names of the two files."""
+    os.makedirs(dirname, exist_ok=True)
+    nodes_file = os.path.join(dirname, 'route_nodes.csv')
+    edges_file = os.path.join(dirname, 'route_edges.csv')
+
+    node_columns = [c for c in nodes.columns if c != 'id']
+    with open(nodes_file, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['id:ID(RouteNode)', ':LABEL', 'location:point{crs:WGS-84}'] +
+                        ['%s:%s' % (c, csv_type(nodes[c])) for c in node_columns])
+        columns = [nodes[c].tolist() for c in ['id', 'lat', 'lon'] + node_columns]
+        for row in zip(*columns):
+            writer.writerow([row[0], 'RouteNode', '{latitude:%r, longitude:%r}' % (row[1], row[2])] +
+                            [csv_value(value) for value in row[3:]])
+
+    edge_columns = [c for c in edges.columns if c not in ('source', 'target')]
+    with open(edges_file, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow([':START_ID(RouteNode)', ':END_ID(RouteNode)', ':TYPE'] +
+                        ['%s:%s' % (c, csv_type(edges[c])) for c in edge_columns])
+        columns = [edges[c].tolist() for c in ['source', 'target'] + edge_columns]
+        for row in zip(*columns):
+            writer.writerow([row[0], row[1], 'ROUTE'] + [csv_value(value) for value in row[2:]])
+    return nodes_file, edges_file
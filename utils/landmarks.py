@@ -0,0 +1,98 @@
+import numpy as np
+
+
+class LandmarkIndex:
+    """ALT (A*, landmarks, triangle inequality) lower bounds for the weights of a CSRGraph.
+
+    For every landmark L and weight the index stores the costs from L to all the nodes
+    (forward) and from all the nodes to L (backward). By the triangle inequality
+    d(v, t) >= d(L, t) - d(L, v) and d(v, t) >= d(v, L) - d(t, L), which gives tight
+    A* heuristics also for weights without any relation to the geographic distance."""
+
+    def __init__(self, node_ids, landmarks, forward, backward, version=None):
+        self.node_ids = np.asarray(node_ids, dtype=str)
+        self.landmarks = np.asarray(landmarks, dtype=np.int64)
+        # weight -> array of shape (number of landmarks, number of nodes)
+        self.forward = forward
+        self.backward = backward
+        # GraphVersion stamp of the graph the costs were computed on
+        self.version = version
+
+    @property
+    def weights(self):
+        return list(self.forward)
+
+    @classmethod
+    def build(cls, graph, weights, n_landmarks=16):
+        """choose the landmarks with the farthest strategy on the first weight and store their costs"""
+        reversed_graph = graph.reversed()
+        selection_weight = weights[0]
+
+        # start from the node farthest from an arbitrary node, then always add the node
+        # farthest from the landmarks already chosen
+        dist = graph.distances_from(0, selection_weight)
+        landmarks = []
+        forward = {weight: [] for weight in weights}
+        backward = {weight: [] for weight in weights}
+        closest = np.full(graph.n_nodes, np.inf)
+        for _ in range(min(n_landmarks, graph.n_nodes)):
+            candidates = np.where(np.isfinite(dist), dist, -1)
+            if landmarks:
+                candidates = np.where(np.isfinite(closest), closest, -1)
+                candidates[landmarks] = -1
+            landmark = int(np.argmax(candidates))
+            if candidates[landmark] <= 0 and landmarks:
+                break
+            landmarks.append(landmark)
+            for weight in weights:
+                forward[weight].append(graph.distances_from(landmark, weight))
+                backward[weight].append(reversed_graph.distances_from(landmark, weight))
+            closest = np.minimum(closest, forward[selection_weight][-1])
+
+        return cls(graph.node_ids, landmarks,
+                   {weight: np.array(values) for weight, values in forward.items()},
+                   {weight: np.array(values) for weight, values in backward.items()}, graph.version)
+
+    def save(self, filename):
+        arrays = {}
+        for weight in self.weights:
+            arrays['forward_' + weight] = self.forward[weight]
+            arrays['backward_' + weight] = self.backward[weight]
+        with open(filename, 'wb') as f:
+            np.savez(f, node_ids=self.node_ids, landmarks=self.landmarks, version=np.array(self.version or ''),
+                     weight_names=np.array(self.weights, dtype=str), **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            weights = data['weight_names'].tolist()
+            version = (str(data['version']) or None) if 'version' in data.files else None
+            return cls(data['node_ids'], data['landmarks'],
+                       {weight: data['forward_' + weight] for weight in weights},
+                       {weight: data['backward_' + weight] for weight in weights}, version)
+
+    def check_version(self, version):
+        """the costs of another version of the graph may overestimate the distances (inadmissible A* bounds)"""
+        if version != self.version:
+            raise ValueError("The landmark index was built for version %s of the graph, the current one is %s: "
+                             "build it again with graph/build_landmarks.py" % (self.version, version))
+
+    def reordered(self, node_ids):
+        """same index with the nodes in the order of node_ids (e.g. a graph loaded again from neo4j)"""
+        index = {node_id: i for i, node_id in enumerate(self.node_ids.tolist())}
+        order = np.array([index[node_id] for node_id in np.asarray(node_ids, dtype=str).tolist()])
+        position = np.empty(len(order), dtype=np.int64)
+        position[order] = np.arange(len(order))
+        return LandmarkIndex(node_ids, position[self.landmarks],
+                             {weight: values[:, order] for weight, values in self.forward.items()},
+                             {weight: values[:, order] for weight, values in self.backward.items()}, self.version)
+
+    def lower_bounds(self, t, weight):
+        """lower bounds of the cost from every node to the node in position t"""
+        forward = self.forward[weight]
+        backward = self.backward[weight]
+        with np.errstate(invalid='ignore'):
+            bounds = np.concatenate([forward[:, t:t + 1] - forward, backward - backward[:, t:t + 1]])
+        # landmarks that cannot reach (or be reached by) a node give no information on it
+        bounds[~np.isfinite(bounds)] = 0
+        return np.maximum(bounds.max(axis=0), 0)
@@ -0,0 +1,262 @@
+import os
+import csv
+import json
+import numpy as np
+import pandas as pd
+
+
+class CSVPathWriter:
+    """Append the paths of each row of the matrix to the csv file as soon as the row is completed."""
+
+    fields = ['start_point', 'end_point', 'cost', 'path_nodes']
+
+    def __init__(self, filename, state=None):
+        if state is None:
+            self.file = open(filename, 'w', newline='')
+            self.writer = csv.writer(self.file, lineterminator='\n')
+            self.writer.writerow(self.fields)
+        else:
+            self.file = open(filename, 'r+', newline='')
+            self.file.truncate(state['offset'])
+            self.file.seek(state['offset'])
+            self.writer = csv.writer(self.file, lineterminator='\n')
+
+    def write_row(self, paths):
+        for path in paths:
+            self.writer.writerow([path['start_point'], path['end_point'], path['cost'], ' '.join(path['path_nodes'])])
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def state(self):
+        return {'offset': self.file.tell()}
+
+    def close(self):
+        self.file.close()
+
+
+class BinaryPathWriter:
+    """Append the paths of each row of the matrix to a binary path store.
+
+    The store is a directory with raw arrays that can be memory-mapped by PathStore:
+    points.npy (the points of the matrix), pairs.bin (int32 start and end point
+    indices), costs.bin (float64), nodes.bin (int32 indices in node_ids.txt of the
+    nodes of all the paths, one after the other) and offsets.bin (int64 start of
+    each path in nodes.bin, followed by the end of the last one)."""
+
+    def __init__(self, dirname, points, state=None):
+        self.dirname = dirname
+        self.point_index = {point: i for i, point in enumerate(points)}
+        if state is None:
+            os.makedirs(dirname, exist_ok=True)
+            np.save(os.path.join(dirname, 'points.npy'), np.asarray(points, dtype=str))
+            self.node_index = {}
+            files = {name: open(os.path.join(dirname, name), 'wb') for name in PathStore.arrays}
+            files['node_ids.txt'] = open(os.path.join(dirname, 'node_ids.txt'), 'w')
+            np.zeros(1, dtype=np.int64).tofile(files['offsets.bin'])
+            self.n_nodes = 0
+        else:
+            with open(os.path.join(dirname, 'node_ids.txt')) as f:
+                node_ids = f.read().split('\n')[:state['node_ids']]
+            self.node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+            sizes = {'pairs.bin': 2 * 4 * state['paths'], 'costs.bin': 8 * state['paths'],
+                     'offsets.bin': 8 * (state['paths'] + 1), 'nodes.bin': 4 * state['nodes']}
+            files = {}
+            for name in PathStore.arrays:
+                files[name] = open(os.path.join(dirname, name), 'r+b')
+                files[name].truncate(sizes[name])
+                files[name].seek(sizes[name])
+            files['node_ids.txt'] = open(os.path.join(dirname, 'node_ids.txt'), 'r+')
+            files['node_ids.txt'].truncate(state['node_ids_offset'])
+            files['node_ids.txt'].seek(state['node_ids_offset'])
+            self.n_nodes = state['nodes']
+        self.files = files
+        self.n_paths = os.path.getsize(os.path.join(dirname, 'costs.bin')) // 8
+
+    def write_row(self, paths):
+        pairs = np.empty((len(paths), 2), dtype=np.int32)
+        costs = np.empty(len(paths), dtype=np.float64)
+        offsets = np.empty(len(paths), dtype=np.int64)
+        nodes = []
+        new_node_ids = []
+        for i, path in enumerate(paths):
+            pairs[i] = self.point_index[path['start_point']], self.point_index[path['end_point']]
+            costs[i] = path['cost']
+            for node_id in path['path_nodes']:
+                if node_id not in self.node_index:
+                    self.node_index[node_id] = len(self.node_index)
+                    new_node_ids.append(node_id)
+                nodes.append(self.node_index[node_id])
+            offsets[i] = self.n_nodes + len(nodes)
+        pairs.tofile(self.files['pairs.bin'])
+        costs.tofile(self.files['costs.bin'])
+        np.asarray(nodes, dtype=np.int32).tofile(self.files['nodes.bin'])
+        offsets.tofile(self.files['offsets.bin'])
+        self.files['node_ids.txt'].write(''.join(node_id + '\n' for node_id in new_node_ids))
+        self.n_nodes += len(nodes)
+        self.n_paths += len(paths)
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+
+    def state(self):
+        return {'paths': self.n_paths, 'nodes': self.n_nodes, 'node_ids': len(self.node_index),
+                'node_ids_offset': self.files['node_ids.txt'].tell()}
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+class PathStore:
+    """Read-only access to a binary path store written by BinaryPathWriter, without parsing it."""
+
+    arrays = {'pairs.bin': np.int32, 'costs.bin': np.float64, 'nodes.bin': np.int32, 'offsets.bin': np.int64}
+
+    def __init__(self, dirname):
+        self.points = np.load(os.path.join(dirname, 'points.npy'), mmap_mode='r')
+        for name, dtype in self.arrays.items():
+            filename = os.path.join(dirname, name)
+            if os.path.getsize(filename) == 0:
+                array = np.zeros(0, dtype=dtype)
+            else:
+                array = np.memmap(filename, dtype=dtype, mode='r')
+            setattr(self, name.split('.')[0], array)
+        self.pairs = self.pairs.reshape(-1, 2)
+        with open(os.path.join(dirname, 'node_ids.txt')) as f:
+            self.node_ids = f.read().split('\n')[:-1]
+        self._point_index = None
+        self._pair_index = None
+
+    def __len__(self):
+        return len(self.costs)
+
+    def path_nodes(self, i):
+        """indices in node_ids of the nodes of the i-th path"""
+        return self.nodes[self.offsets[i]:self.offsets[i + 1]]
+
+    def find(self, start_point, end_point):
+        """position of the path between the two points and whether it is stored in reverse order"""
+        if self._pair_index is None:
+            self._point_index = {point: i for i, point in enumerate(self.points.tolist())}
+            self._pair_index = {(int(a), int(b)): i for i, (a, b) in enumerate(self.pairs.tolist())}
+        a = self._point_index[str(start_point)]
+        b = self._point_index[str(end_point)]
+        if (a, b) in self._pair_index:
+            return self._pair_index[(a, b)], False
+        return self._pair_index[(b, a)], True
+
+    def get_path(self, start_point, end_point):
+        """cost and node ids of the path between the two points"""
+        i, reverse = self.find(start_point, end_point)
+        nodes = [self.node_ids[n] for n in self.path_nodes(i).tolist()]
+        if reverse:
+            nodes.reverse()
+        return float(self.costs[i]), nodes
+
+
+class CSVPathStore:
+    """Paths of a csv file written by CSVPathWriter, with the get_path interface of PathStore."""
+
+    def __init__(self, filename):
+        self.paths = {}
+        with open(filename, newline='') as f:
+            reader = csv.reader(f)
+            next(reader)
+            for start_point, end_point, cost, path_nodes in reader:
+                self.paths[(start_point, end_point)] = (float(cost), path_nodes.split())
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get_path(self, start_point, end_point):
+        """cost and node ids of the path between the two points"""
+        start_point, end_point = str(start_point), str(end_point)
+        if (start_point, end_point) in self.paths:
+            return self.paths[(start_point, end_point)]
+        cost, nodes = self.paths[(end_point, start_point)]
+        return cost, nodes[::-1]
+
+
+def load_path_store(filename):
+    """PathStore for a binary path store directory, CSVPathStore for a csv file"""
+    if os.path.isdir(filename):
+        return PathStore(filename)
+    return CSVPathStore(filename)
+
+
+def save_weight_matrix(weight_matrix, points, filename):
+    """write the matrix as csv with the points as labels, or as .npy with the points in a _points.npy file"""
+    if filename.endswith('.npy'):
+        np.save(filename, weight_matrix)
+        np.save(filename[:-len('.npy')] + '_points.npy', np.asarray(points, dtype=str))
+    else:
+        weight_matrix_df = pd.DataFrame(weight_matrix, index=points, columns=points)
+        weight_matrix_df.to_csv(filename)
+
+
+def load_weight_matrix(filename):
+    """return the points and the weight matrix, memory-mapped if the matrix is a .npy file"""
+    if filename.endswith('.npy'):
+        weight_matrix = np.load(filename, mmap_mode='r')
+        points = np.load(filename[:-len('.npy')] + '_points.npy')
+        return points, weight_matrix
+    weight_matrix_df = pd.read_csv(filename, index_col=0, dtype={0: str})
+    return weight_matrix_df.index.astype(str).values, weight_matrix_df.values
+
+
+class MatrixCheckpoint:
+    """Json-lines file recording the completed rows of a matrix job.
+
+    The first line describes the job (points and weight), then there is one line for
+    each completed row with its costs and the state of the path writer after the row."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+
+    def load(self, points, weight):
+        """return the costs of the completed rows and the last state of the path writer"""
+        if not os.path.exists(self.filename):
+            return {}, None
+        with open(self.filename) as f:
+            lines = f.readlines()
+        header = json.loads(lines[0])
+        if header['points'] != list(points) or header['weight'] != weight:
+            raise ValueError("The checkpoint %s was created for different points or weight" % self.filename)
+
+        rows = {}
+        state = header['paths']
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # last line only partially written before the crash
+                break
+            rows[entry['row']] = entry['costs']
+            state = entry['paths']
+        return rows, state
+
+    def start(self, points, weight, state):
+        self.file = open(self.filename, 'w')
+        self._write({'points': list(points), 'weight': weight, 'paths': state})
+
+    def resume(self, rows, state):
+        """rewrite the checkpoint without a partially written last line"""
+        with open(self.filename) as f:
+            header = json.loads(f.readline())
+        self.file = open(self.filename, 'w')
+        self._write(header)
+        for index_row, costs in rows.items():
+            self._write({'row': index_row, 'costs': costs, 'paths': state})
+
+    def add_row(self, index_row, costs, state):
+        self._write({'row': index_row, 'costs': costs, 'paths': state})
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def remove(self):
+        self.file.close()
+        os.remove(self.filename)
@@ -0,0 +1,86 @@
+import re
+import xml.etree.ElementTree as ET
+import networkx as nx
+from utils.graph_ingestion import point_distance, NEO4J_EARTH_RADIUS, OSMNX_EARTH_RADIUS, FOOT_CLASS_RULES, BIKE_CLASS_RULES
+
+
+# the ways of the graph are the ones of osmnx network_type='all': a way is excluded when one of these
+# tags matches the regular expression
+EXCLUDED_WAY_TAGS = {
+    'area': 'yes',
+    'access': 'private',
+    'highway': 'abandoned|construction|no|planned|platform|proposed|raceway|razed',
+    'service': 'private',
+}
+# tags kept as properties of the nodes and of the edges, as osmnx does, plus the ones used by the road classes
+NODE_TAGS = ['ref', 'highway']
+WAY_TAGS = ['bridge', 'tunnel', 'oneway', 'lanes', 'ref', 'name', 'highway', 'maxspeed', 'service', 'access',
+            'area', 'landuse', 'width', 'est_width', 'junction']
+WAY_TAGS += sorted({name for rules in (FOOT_CLASS_RULES, BIKE_CLASS_RULES) for _, conditions in rules
+                    for name in conditions if name not in WAY_TAGS})
+ONEWAY_VALUES = {'yes', 'true', '1', '-1', 'reverse', 'T', 'F'}
+REVERSED_VALUES = {'-1', 'reverse', 'T'}
+
+
+def read_osc(filename):
+    """nodes and ways of an OSM change file (.osc), as {id: (action, lat, lon, tags)} and
+    {id: (action, node ids, tags)} with action 'create', 'modify' or 'delete'. When an element is
+    changed more than once the last change is kept. Relations are not used by the graph."""
+    nodes, ways = {}, {}
+    for action in ET.parse(filename).getroot():
+        for element in action:
+            tags = {tag.get('k'): tag.get('v') for tag in element.findall('tag')}
+            if element.tag == 'node':
+                lat, lon = element.get('lat'), element.get('lon')
+                nodes[element.get('id')] = (action.tag, None if lat is None else float(lat),
+                                            None if lon is None else float(lon), tags)
+            elif element.tag == 'way':
+                ways[element.get('id')] = (action.tag, [nd.get('ref') for nd in element.findall('nd')], tags)
+    return nodes, ways
+
+
+def is_route_way(tags):
+    """the way is part of the graph (a highway not excluded by EXCLUDED_WAY_TAGS)"""
+    if 'highway' not in tags:
+        return False
+    return not any(name in tags and re.search(pattern, tags[name]) for name, pattern in EXCLUDED_WAY_TAGS.items())
+
+
+def way_segments(node_ids, tags):
+    """directed edges (source, target, reversed) of a way, as osmnx builds them: both directions for
+    two-way roads, only the direction of travel for one-way roads"""
+    oneway = tags.get('oneway') in ONEWAY_VALUES or tags.get('junction') == 'roundabout'
+    if oneway and tags.get('oneway') in REVERSED_VALUES:
+        node_ids = node_ids[::-1]
+    pairs = [(u, v) for u, v in zip(node_ids[:-1], node_ids[1:]) if u != v]
+    segments = [(u, v, False) for u, v in pairs]
+    if not oneway:
+        segments += [(v, u, True) for u, v in pairs]
+    return segments, oneway
+
+
+def change_graph(ways, coordinates, node_tags=None):
+    """osmnx-like MultiDiGraph of the given ways ({id: (node ids, tags)}), with the coordinates
+    {node id: (lat, lon)} of their nodes. The segments with a node without coordinates are left out
+    and returned as the second value."""
+    node_tags = node_tags or {}
+    G = nx.MultiDiGraph()
+    missing = []
+    for way_id, (node_ids, tags) in ways.items():
+        segments, oneway = way_segments(node_ids, tags)
+        attributes = {name: tags[name] for name in WAY_TAGS if name in tags}
+        attributes['osmid'] = int(way_id)
+        attributes['oneway'] = oneway
+        for u, v, reversed_ in segments:
+            if u not in coordinates or v not in coordinates:
+                missing.append((way_id, u, v))
+                continue
+            for node in (u, v):
+                if node not in G:
+                    lat, lon = coordinates[node]
+                    tags_of_node = {name: value for name, value in node_tags.get(node, {}).items() if name in NODE_TAGS}
+                    G.add_node(node, y=lat, x=lon, **tags_of_node)
+            length = point_distance(coordinates[u][0], coordinates[u][1], coordinates[v][0], coordinates[v][1])
+            G.add_edge(u, v, reversed=reversed_, length=float(length) * OSMNX_EARTH_RADIUS / NEO4J_EARTH_RADIUS,
+                       **attributes)
+    return G, missing
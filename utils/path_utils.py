@@ -13,9 +13,13 @@ import time
 # import pandas as pd
 from utils.db_utils import Neo4jConnection
 from utils.select_amenity import SelectAmenities
+from utils.csr_graph import check_property_name, WEIGHT_PATTERN
 import logging
 logging.getLogger("neo4j").setLevel(logging.ERROR)
 
+
+DEFAULT_METRICS = ['distance', 'green_area_weight']
+
 class PathUtils:
     
     def elem_to_feature(elem, geomType):
@@ -57,26 +61,38 @@ class PathUtils:
             return result.values()
             
 
-    def evaluate_path_metrics(self,conn,path):
-        distance = 0
-        green_area_weight = 0
+    def evaluate_paths_metrics(self,conn,paths,metrics=DEFAULT_METRICS):
+        """sums of the metrics along many paths (lists of FootNode ids) with a single query.
+        Time-dependent metrics are selected with the index of the time slot, e.g. pm25_per_meter[1].
+        Returns one dict metric -> sum for each path, None for the paths with a missing ROUTE."""
+        metrics = [check_property_name(m, WEIGHT_PATTERN) for m in metrics]
         with conn.driver.session() as session:
-            for index in range(len(path)-1):
-                start_node = path[index]
-                end_node = path[index+1]
-                
-                query = """
-                match (:FootNode{id: '%s'})-[r:ROUTE]-(:FootNode{id: '%s'})
-                return r.distance as distance, r.green_area_weight as green_area_weight"""%(start_node,end_node)
-                result = session.run(query)
-                
-                values = result.values()[0]
-                
-                distance+=values[0]
-                green_area_weight+=values[1]
-                
-        return distance, green_area_weight
+            query = """
+            UNWIND range(0, size($paths)-1) as i
+            WITH i, $paths[i] as path
+            UNWIND range(0, size(path)-2) as j
+            MATCH (:FootNode{id: path[j]})-[r:ROUTE]-(:FootNode{id: path[j+1]})
+            WITH i, j, r ORDER BY r.distance
+            WITH i, j, collect(r)[0] as r
+            RETURN i, count(j) as hops%s"""%(''.join(', sum(r.%s)' % m for m in metrics))
+            result = session.run(query, paths=[[str(node) for node in path] for path in paths])
+            values = {record[0]: record.values()[1:] for record in result}
+
+        evaluated = []
+        for i, path in enumerate(paths):
+            if len(path) < 2:
+                evaluated.append({m: 0 for m in metrics})
+            elif i not in values or values[i][0] < len(path) - 1:
+                evaluated.append(None)
+            else:
+                evaluated.append(dict(zip(metrics, values[i][1:])))
+        return evaluated
 
+    def evaluate_path_metrics(self,conn,path):
+        metrics = self.evaluate_paths_metrics(conn, [path], ['distance', 'green_area_weight'])[0]
+        if metrics is None:
+            raise ValueError("The nodes of the path are not linked by ROUTE relationships")
+        return metrics['distance'], metrics['green_area_weight']
 
 
 def add_options():
@@ -0,0 +1,101 @@
+import os
+import time
+import sqlite3
+
+
+class RouteCache:
+    """Disk-backed cache of the best routes, keyed by (source, target, weight).
+
+    The cache is a sqlite file, so it is shared by routing.py, tsp.py and any other
+    process on the same machine. It records the graph version it was filled with
+    (see Neo4jConnection.get_graph_version) and is emptied as soon as it is opened
+    with a different version, i.e. after the graph or its edge weights changed.
+    When the stored routes exceed max_size bytes the least recently used ones are
+    evicted (checked every check_every insertions)."""
+
+    check_every = 100
+
+    def __init__(self, filename, graph_version, max_size=1024 * 1024 * 1024):
+        self.filename = filename
+        self.graph_version = str(graph_version)
+        self.max_size = max_size
+        self._puts = 0
+        self._db = None
+        self._pid = None
+        self.hits = 0
+        self.misses = 0
+        self.db()
+
+    def db(self):
+        # sqlite connections must not be shared with the worker processes
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.filename, timeout=60)
+            self._pid = os.getpid()
+            with self._db:
+                self._db.execute("""CREATE TABLE IF NOT EXISTS route (
+                    source TEXT, target TEXT, weight TEXT, cost REAL, nodes TEXT, edges TEXT,
+                    size INTEGER, last_access REAL, PRIMARY KEY (source, target, weight))""")
+                self._db.execute("CREATE INDEX IF NOT EXISTS route_last_access ON route (last_access)")
+                self._db.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+                row = self._db.execute("SELECT value FROM metadata WHERE key = 'graph_version'").fetchone()
+                if row is None or row[0] != self.graph_version:
+                    self._db.execute("DELETE FROM route")
+                    self._db.execute("INSERT OR REPLACE INTO metadata VALUES ('graph_version', ?)",
+                                     (self.graph_version,))
+        return self._db
+
+    def get(self, source, target, weight):
+        """the cached route as returned by Routing.find_best_path, None if it is not in the cache"""
+        db = self.db()
+        row = db.execute("SELECT cost, nodes, edges FROM route WHERE source = ? AND target = ? AND weight = ?",
+                         (str(source), str(target), weight)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with db:
+            db.execute("UPDATE route SET last_access = ? WHERE source = ? AND target = ? AND weight = ?",
+                       (time.time(), str(source), str(target), weight))
+        return {"path": [int(e) for e in row[2].split()], "cost": row[0], "nodes": row[1].split()}
+
+    def put(self, source, target, weight, route):
+        nodes = ' '.join(route["nodes"])
+        edges = ' '.join(str(e) for e in route["path"])
+        db = self.db()
+        with db:
+            db.execute("INSERT OR REPLACE INTO route VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (str(source), str(target), weight, route["cost"], nodes, edges,
+                        len(nodes) + len(edges), time.time()))
+        self._puts += 1
+        if self._puts % self.check_every == 0:
+            self.evict()
+
+    def size(self):
+        return self.db().execute("SELECT coalesce(sum(size), 0) FROM route").fetchone()[0]
+
+    def evict(self):
+        """remove the least recently used routes until the cache is below 90% of max_size"""
+        size = self.size()
+        if size <= self.max_size:
+            return
+        db = self.db()
+        removed = 0
+        with db:
+            for source, target, weight, route_size in db.execute(
+                    "SELECT source, target, weight, size FROM route ORDER BY last_access").fetchall():
+                if size - removed <= 0.9 * self.max_size:
+                    break
+                db.execute("DELETE FROM route WHERE source = ? AND target = ? AND weight = ?",
+                           (source, target, weight))
+                removed += route_size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = None
+        return state
+
+    def close(self):
+        if self._db is not None:
+            self.evict()
+            self._db.close()
+            self._db = None
@@ -0,0 +1,328 @@
+import time
+import numpy as np
+
+
+# largest number of points solved exactly by default (Held-Karp needs n^2 * 2^n operations)
+EXACT_LIMIT = 16
+
+
+def tour_cost(matrix, tour):
+    """cost of the closed tour (list of point indices, the first point is not repeated at the end)"""
+    return float(sum(matrix[tour[i - 1]][tour[i]] for i in range(len(tour)))) if len(tour) > 1 else 0.0
+
+
+def finite_costs(matrix):
+    """same matrix with a huge finite cost for the pairs that cannot be reached"""
+    matrix = np.asarray(matrix, dtype=np.float64)
+    finite = np.isfinite(matrix)
+    if finite.all():
+        return matrix
+    big = 1e6 * (np.max(np.abs(matrix[finite])) + 1) if finite.any() else 1.0
+    return np.where(finite, matrix, big)
+
+
+def held_karp(matrix):
+    """exact tour by dynamic programming over the subsets of points, starting from point 0.
+    Returns (tour, cost)."""
+    original = np.asarray(matrix, dtype=np.float64)
+    matrix = finite_costs(original)
+    n = len(matrix)
+    if n <= 2:
+        tour = list(range(n))
+        return tour, tour_cost(original, tour)
+
+    # point i + 1 is bit i of the subset masks, dp[mask, i] is the cheapest way to leave
+    # point 0, visit the points in mask and stop in point i + 1
+    m = n - 1
+    full = (1 << m) - 1
+    dp = np.full((1 << m, m), np.inf)
+    parent = np.full((1 << m, m), -1, dtype=np.int8 if m < 127 else np.int16)
+    for i in range(m):
+        dp[1 << i, i] = matrix[0, i + 1]
+
+    masks = np.arange(1 << m)
+    popcount = np.zeros(1 << m, dtype=np.int32)
+    for i in range(m):
+        popcount += (masks >> i) & 1
+    costs = matrix[1:, 1:]
+    for size in range(2, m + 1):
+        layer = masks[popcount == size]
+        for i in range(m):
+            current = layer[(layer >> i) & 1 == 1]
+            previous = current ^ (1 << i)
+            # dp is inf for the points that are not in previous
+            candidates = dp[previous] + costs[:, i]
+            best = np.argmin(candidates, axis=1)
+            dp[current, i] = candidates[np.arange(len(current)), best]
+            parent[current, i] = best
+
+    closing = dp[full] + matrix[1:, 0]
+    last = int(np.argmin(closing))
+    tour = []
+    mask = full
+    while last != -1:
+        tour.append(last + 1)
+        last, mask = int(parent[mask, last]), mask ^ (1 << last)
+    tour.append(0)
+    tour.reverse()
+    return tour, tour_cost(original, tour)
+
+
+def nearest_neighbour(matrix, start=0):
+    """tour that always moves to the closest point not visited yet"""
+    n = len(matrix)
+    visited = [False] * n
+    visited[start] = True
+    tour = [start]
+    for _ in range(n - 1):
+        row = matrix[tour[-1]]
+        nxt = min((j for j in range(n) if not visited[j]), key=lambda j: row[j])
+        visited[nxt] = True
+        tour.append(nxt)
+    return tour
+
+
+def expired(deadline):
+    return deadline is not None and time.monotonic() > deadline
+
+
+def two_opt(matrix, tour, deadline=None):
+    """reverse segments of the tour while that makes it shorter (symmetric costs)"""
+    n = len(tour)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(n - 1):
+            if expired(deadline):
+                return tour
+            a, b = tour[i], tour[i + 1]
+            for j in range(i + 2, n if i > 0 else n - 1):
+                c, d = tour[j], tour[(j + 1) % n]
+                if matrix[a][c] + matrix[b][d] < matrix[a][b] + matrix[c][d] - 1e-9:
+                    tour[i + 1:j + 1] = tour[i + 1:j + 1][::-1]
+                    a, b = tour[i], tour[i + 1]
+                    improved = True
+    return tour
+
+
+def or_opt(matrix, tour, max_segment=3, reverse=True, deadline=None):
+    """move segments of up to max_segment consecutive points to a better place, also reversed
+    if reverse is True (only for symmetric costs: the cost inside the segment must not change)"""
+    n = len(tour)
+    improved = True
+    while improved:
+        improved = False
+        for length in range(1, min(max_segment, n - 2) + 1):
+            for i in range(1, n - length + 1):
+                if expired(deadline):
+                    return tour
+                segment = tour[i:i + length]
+                prev, nxt = tour[i - 1], tour[(i + length) % n]
+                removed = matrix[prev][segment[0]] + matrix[segment[-1]][nxt] - matrix[prev][nxt]
+                rest = tour[:i] + tour[i + length:]
+                best = None
+                for k in range(len(rest)):
+                    a, b = rest[k], rest[(k + 1) % len(rest)]
+                    if a == prev and b == nxt:
+                        continue
+                    for candidate in ((segment, segment[::-1]) if reverse else (segment,)):
+                        added = matrix[a][candidate[0]] + matrix[candidate[-1]][b] - matrix[a][b]
+                        if added < removed - 1e-9 and (best is None or added < best[0]):
+                            best = (added, k, candidate)
+                if best is not None:
+                    _, k, candidate = best
+                    tour[:] = rest[:k + 1] + list(candidate) + rest[k + 1:]
+                    improved = True
+    return tour
+
+
+def local_search(matrix, tour, symmetric=True, deadline=None):
+    """alternate 2-opt and Or-opt until neither improves the tour or the deadline (time.monotonic())
+    expires. With asymmetric costs reversing a segment changes its cost, so only Or-opt without
+    reversal is used."""
+    best = list(tour)
+    cost = tour_cost(matrix, tour)
+    while not expired(deadline):
+        if symmetric:
+            two_opt(matrix, tour, deadline)
+        or_opt(matrix, tour, reverse=symmetric, deadline=deadline)
+        new_cost = tour_cost(matrix, tour)
+        if not new_cost < cost - 1e-9:
+            break
+        best, cost = list(tour), new_cost
+    tour[:] = best
+    return tour
+
+
+def heuristic_starts(n):
+    """starting points of the heuristic: one per point is cheap up to a few dozen points"""
+    return None if n <= 50 else np.linspace(0, n - 1, 20).astype(int).tolist()
+
+
+def heuristic_tour(matrix, starts=None, deadline=None):
+    """nearest neighbour tours improved by local search, from several starting points.
+    After the deadline (time.monotonic()) no other start is tried and the best tour so far is kept.
+    Returns (tour, cost) with the tour rotated to start from point 0."""
+    matrix = np.asarray(matrix, dtype=np.float64)
+    n = len(matrix)
+    if n <= 3:
+        # with asymmetric costs the two directions of a 3-point tour differ
+        return held_karp(matrix)
+    costs = finite_costs(matrix)
+    symmetric = bool(np.array_equal(costs, costs.T))
+    lists = costs.tolist()
+    best = None
+    for start in (range(n) if starts is None else starts):
+        if best is not None and expired(deadline):
+            break
+        tour = local_search(lists, nearest_neighbour(lists, start), symmetric, deadline)
+        cost = tour_cost(lists, tour)
+        if best is None or cost < best[1]:
+            best = (tour, cost)
+    tour = best[0]
+    zero = tour.index(0)
+    tour = tour[zero:] + tour[:zero]
+    return tour, tour_cost(matrix, tour)
+
+
+def spanning_tree(costs):
+    """minimum spanning tree of a complete graph (Prim), returns (cost, parent of each node)"""
+    n = len(costs)
+    parent = np.zeros(n, dtype=np.int64)
+    if n <= 1:
+        return 0.0, parent
+    in_tree = np.zeros(n, dtype=bool)
+    in_tree[0] = True
+    dist = costs[0].copy()
+    total = 0.0
+    for _ in range(n - 1):
+        j = int(np.argmin(np.where(in_tree, np.inf, dist)))
+        total += dist[j]
+        in_tree[j] = True
+        closer = costs[j] < dist
+        dist[closer] = costs[j][closer]
+        parent[closer & ~in_tree] = j
+    return total, parent
+
+
+def one_tree(costs):
+    """minimum 1-tree: spanning tree of the points 1..n-1 plus the two cheapest edges of point 0.
+    Returns (cost, degree of each point); every tour is a 1-tree."""
+    n = len(costs)
+    cost, parent = spanning_tree(costs[1:, 1:])
+    degrees = np.zeros(n, dtype=np.int64)
+    if n > 2:
+        np.add.at(degrees, parent[1:] + 1, 1)
+        degrees[2:] += 1
+    closest = np.argsort(costs[0, 1:])[:2] + 1
+    degrees[closest] += 1
+    degrees[0] = 2
+    return cost + costs[0, closest].sum(), degrees
+
+
+def held_karp_bound(matrix, upper, iterations=200, deadline=None):
+    """Held-Karp lower bound of the tour cost: subgradient ascent on the node penalties pi of the
+    1-tree bound (costs c[i][j] + pi[i] + pi[j]), stopped early at the deadline (time.monotonic()).
+    Returns (bound, pi)."""
+    costs = np.minimum(matrix, matrix.T)
+    n = len(costs)
+    pi = np.zeros(n)
+    best = (-np.inf, pi)
+    step = 2.0
+    stall = 0
+    for _ in range(iterations):
+        cost, degrees = one_tree(costs + pi[:, None] + pi[None, :])
+        bound = cost - 2 * pi.sum()
+        if bound > best[0] + 1e-9:
+            best = (bound, pi.copy())
+            stall = 0
+        else:
+            stall += 1
+            if stall >= 10:
+                step /= 2
+                stall = 0
+        gradient = degrees - 2
+        norm = float((gradient ** 2).sum())
+        # a 1-tree where every point has two edges is an optimal tour
+        if norm == 0 or step < 1e-6 or best[0] >= upper - 1e-9 or expired(deadline):
+            break
+        pi = pi + step * (upper - bound) / norm * gradient
+    return best
+
+
+def branch_and_bound(matrix, time_limit=None, tour=None):
+    """anytime branch and bound, seeded with the heuristic tour (or the given one).
+    Partial tours from point 0 are extended depth first and pruned with the Held-Karp penalties:
+    a partial tour ending in e costs at least its own edges plus a spanning tree of e, point 0
+    and the points not visited yet. When time_limit (seconds) expires the best tour found is
+    returned with its optimality gap. Returns (tour, cost, gap), gap is 0 for a proven optimum."""
+    deadline = None if time_limit is None else time.monotonic() + time_limit
+    original = np.asarray(matrix, dtype=np.float64)
+    matrix = finite_costs(original)
+    n = len(matrix)
+    if tour is None:
+        tour, _ = heuristic_tour(matrix, heuristic_starts(n), deadline)
+    best_tour, best_cost = list(tour), tour_cost(matrix, tour)
+    if n <= 3:
+        return held_karp(original) + (0.0,)
+
+    root_bound, pi = held_karp_bound(matrix, best_cost, deadline=deadline)
+    penalised = np.minimum(matrix, matrix.T) + pi[:, None] + pi[None, :]
+    offset = 2 * pi.sum()
+    lists = matrix.tolist()
+
+    # stack of (bound, partial tour, cost, penalised cost)
+    stack = [(root_bound, [0], 0.0, 0.0)]
+    lower = root_bound
+    # bounds that differ from the best cost only by rounding do not deserve a search
+    tolerance = 1e-9 * best_cost
+    while stack:
+        if expired(deadline):
+            lower = min(bound for bound, _, _, _ in stack)
+            break
+        bound, path, cost, cost_pi = stack.pop()
+        if bound >= best_cost - tolerance:
+            continue
+        last = path[-1]
+        visited = set(path)
+        remaining = [j for j in range(1, n) if j not in visited]
+        children = []
+        for j in remaining:
+            child_cost = cost + lists[last][j]
+            child_pi = cost_pi + penalised[last, j]
+            if len(remaining) == 1:
+                total = child_cost + lists[j][0]
+                if total < best_cost - 1e-9:
+                    best_tour, best_cost = path + [j], total
+                continue
+            rest = [0, j] + [k for k in remaining if k != j]
+            tree, _ = spanning_tree(penalised[np.ix_(rest, rest)])
+            child_bound = max(child_pi + tree - offset, root_bound)
+            if child_bound < best_cost - tolerance:
+                children.append((child_bound, path + [j], child_cost, child_pi))
+        # the most promising child is explored first
+        children.sort(key=lambda child: -child[0])
+        stack.extend(children)
+    else:
+        lower = best_cost
+
+    cost = tour_cost(original, best_tour)
+    gap = max(0.0, (best_cost - min(lower, best_cost)) / best_cost) if best_cost > 0 else 0.0
+    return best_tour, cost, gap
+
+
+def solve_tsp(matrix, solver='auto', exact_limit=EXACT_LIMIT, time_limit=None):
+    """best closed tour through all the points of a cost matrix.
+    solver is 'exact' (Held-Karp), 'heuristic' (nearest neighbour + 2-opt/Or-opt),
+    'branch_and_bound' (anytime, stopped after time_limit seconds) or 'auto' (exact up to
+    exact_limit points, then branch and bound if there is a time limit, heuristic otherwise).
+    Returns (tour, cost, gap): the tour starts from point 0, gap is the relative distance from
+    the proven lower bound (0 for an optimal tour, None when no bound is available)."""
+    n = len(matrix)
+    if solver == 'exact' or (solver == 'auto' and n <= exact_limit):
+        return held_karp(matrix) + (0.0,)
+    if solver == 'branch_and_bound' or (solver == 'auto' and time_limit is not None):
+        return branch_and_bound(matrix, time_limit)
+    if solver in ('heuristic', 'auto'):
+        return heuristic_tour(matrix, heuristic_starts(n)) + (None,)
+    raise ValueError("Unknown TSP solver: %s" % solver)